@@ -0,0 +1,120 @@
+"""Check the numpy bootstrap against the pure Python bootstrap."""
+
+import os.path
+import random
+import sys
+import unittest
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from warmup.bootstrapper import _kalibera_indices, _median_ci, _row_percentiles
+from warmup.bootstrapper import _summarise_statistics, bootstrap_mean_intervals
+from warmup.bootstrapper import bootstrap_statistics_numpy, bootstrap_steady_perf_numpy
+from warmup.bootstrapper import optimal_block_length
+
+LEVELS = ('0.99', '0.95', '0.9')
+
+
+def steady_segments(seed, n_pexecs=10, length=20):
+    rng = random.Random(seed)
+    return [[[rng.gauss(1.0, 0.05) for _ in xrange(length)]] for _ in xrange(n_pexecs)]
+
+
+class TestKaliberaIndices(unittest.TestCase):
+    def test_rounding(self):
+        # libkalibera rounds to one decimal place before truncating, so the
+        # (exclusive) upper bound is only rounded up when (1 - exclude) *
+        # length is within 0.1 below an integer.
+        self.assertEqual(_kalibera_indices(100000, '0.99'), ((49999, 50000), 500, 99500))
+        self.assertEqual(_kalibera_indices(100020, '0.99'), ((50009, 50010), 500, 99519))
+        self.assertEqual(_kalibera_indices(201, '0.95'), ((100, ), 5, 196))
+        self.assertEqual(_kalibera_indices(1005, '0.99'), ((502, ), 5, 1000))
+        self.assertEqual(_kalibera_indices(180, '0.99'), ((89, 90), 0, 179))
+        self.assertRaises(AssertionError, _kalibera_indices, 100, 0.99)
+
+    def test_partitioned(self):
+        # The numpy path reads the same order statistics from a partitioned
+        # array as the pure Python path does from a sorted list.
+        rng = numpy.random.RandomState(0)
+        for length in (180, 201, 1999, 100000, 100020):
+            values = rng.normal(1.0, 0.1, length)
+            means = sorted(values.tolist())
+            results = _summarise_statistics(values.reshape(1, length), ('mean', ), LEVELS)
+            for level in LEVELS:
+                median, ci, _ = _median_ci(means, level)
+                _, lower_index, upper_index = _kalibera_indices(length, level)
+                self.assertEqual(results['mean']['estimate'], median)
+                self.assertEqual(results['mean']['intervals'][level],
+                                 {'ci': ci, 'lower': means[lower_index],
+                                  'upper': means[upper_index - 1]})
+
+
+class TestBootstrap(unittest.TestCase):
+    def test_numpy_matches_python(self):
+        # Different random number generators, so only statistically equal.
+        data = steady_segments(1)
+        expected, expected_n = bootstrap_mean_intervals(data, LEVELS[:2], seed=2)
+        results, n_resamples = bootstrap_statistics_numpy(data, ('mean', ), LEVELS[:2], seed=2)
+        self.assertEqual(n_resamples, expected_n)
+        estimate = results['mean']['estimate']
+        for level in LEVELS[:2]:
+            interval = results['mean']['intervals'][level]
+            expected_interval = expected['mean']['intervals'][level]
+            ci = expected_interval['ci']
+            self.assertLess(abs(estimate - expected['mean']['estimate']), 0.05 * ci)
+            self.assertLess(abs(interval['ci'] - ci), 0.05 * ci)
+            self.assertLess(abs(interval['lower'] - expected_interval['lower']), 0.05 * ci)
+            self.assertLess(abs(interval['upper'] - expected_interval['upper']), 0.05 * ci)
+
+    def test_steady_perf_numpy(self):
+        data = steady_segments(3)
+        results, n_resamples = bootstrap_statistics_numpy(data, seed=4)
+        self.assertEqual(bootstrap_steady_perf_numpy(data, seed=4),
+                         (results['mean']['estimate'],
+                          results['mean']['intervals']['0.99']['ci'], n_resamples))
+
+    def test_statistics(self):
+        # Other statistics and levels come from the same resamples, and do not
+        # change the results for the mean.
+        data = steady_segments(5, n_pexecs=4, length=3)
+        mean_only, _ = bootstrap_statistics_numpy(data, ('mean', ), ('0.99', ), seed=6)
+        results, _ = bootstrap_statistics_numpy(data, ('mean', 'median', 'p95'), LEVELS, seed=6)
+        self.assertEqual(results['mean']['estimate'], mean_only['mean']['estimate'])
+        self.assertEqual(results['mean']['intervals']['0.99'],
+                         mean_only['mean']['intervals']['0.99'])
+        self.assertEqual(sorted(results), ['mean', 'median', 'p95'])
+        self.assertEqual(sorted(results['median']['intervals']), sorted(LEVELS))
+
+    def test_row_percentiles(self):
+        rng = numpy.random.RandomState(7)
+        resamples = [rng.normal(size=(50, 7)), rng.normal(size=(50, 4))]
+        expected = numpy.percentile(numpy.concatenate(resamples, axis=1),
+                                    [5.0, 50.0, 95.0], axis=1)
+        numpy.testing.assert_allclose(_row_percentiles(numpy, resamples, [5.0, 50.0, 95.0]),
+                                      expected)
+
+
+class TestOptimalBlockLength(unittest.TestCase):
+    def autoregressive(self, rng, size, phi):
+        noise = rng.normal(size=size)
+        data = numpy.zeros(size)
+        for index in xrange(1, size):
+            data[index] = phi * data[index - 1] + noise[index]
+        return data
+
+    def test_block_length(self):
+        rng = numpy.random.RandomState(0)
+        for size in (3, 10, 100, 1000):
+            self.assertEqual(optimal_block_length(rng.normal(size=size)), 1)
+        self.assertGreater(optimal_block_length(self.autoregressive(rng, 1000, 0.9)), 10)
+
+    def test_short(self):
+        # No lag has K_N (5) autocorrelations after it, so the flat-top window
+        # is as wide as possible, rather than treating a truncated (or empty)
+        # run of autocorrelations as insignificant.
+        data = [0.189, 0.582, -1.004, 0.884, -0.782, 0.086]
+        self.assertEqual(optimal_block_length(data), 2)
+
+if __name__ == '__main__':
+    unittest.main()
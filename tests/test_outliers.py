@@ -0,0 +1,65 @@
+"""Check that the outlier engines agree with _tukey_all_outliers()."""
+
+import os.path
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from warmup.outliers import _tukey_all_outliers, get_all_outliers, get_all_outliers_batch
+from warmup.outliers import OnlineOutlierDetector
+
+WINDOW_SIZES = (2, 3, 4, 5, 10, 11, 50, 200)
+
+
+def random_run_sequence(rng, length):
+    """Noisy iteration times with ties (from rounding) and occasional spikes."""
+    data = list()
+    for _ in xrange(length):
+        value = round(rng.gauss(1.0, 0.01), rng.choice((2, 4, 8)))
+        if rng.random() < 0.03:
+            value *= rng.choice((0.5, 2.0, 10.0))
+        data.append(value)
+    return data
+
+
+class TestOutlierEngines(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(1234)
+
+    def test_incremental(self):
+        for window_size in WINDOW_SIZES:
+            for length in (0, 1, window_size - 1, window_size, window_size + 1, 300):
+                data = random_run_sequence(self.rng, length)
+                self.assertEqual(get_all_outliers(data, window_size),
+                                 _tukey_all_outliers(data, window_size))
+
+    def test_batch(self):
+        for window_size in WINDOW_SIZES:
+            # Pexecs of different lengths are batched separately.
+            p_execs = [random_run_sequence(self.rng, self.rng.choice((window_size, 120, 300)))
+                       for _ in xrange(6)]
+            expected = [_tukey_all_outliers(p_exec, window_size) for p_exec in p_execs]
+            self.assertEqual(get_all_outliers_batch(p_execs, window_size), expected)
+            # A small max_elements splits the full windows into many chunks.
+            self.assertEqual(get_all_outliers_batch(p_execs, window_size, max_elements=64),
+                             expected)
+
+    def test_online(self):
+        for window_size in WINDOW_SIZES:
+            for length in (0, 1, window_size, 300):
+                data = random_run_sequence(self.rng, length)
+                detector = OnlineOutlierDetector(window_size)
+                outliers = list()
+                position = 0
+                while position < length:
+                    step = self.rng.randint(1, 7)
+                    outliers.extend(detector.extend(data[position:position + step]))
+                    position += step
+                outliers.extend(detector.finish())
+                self.assertEqual(outliers, _tukey_all_outliers(data, window_size))
+                self.assertRaises(ValueError, detector.add, 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
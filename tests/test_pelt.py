@@ -0,0 +1,148 @@
+"""Tests of the PELT changepoint engine."""
+
+import math
+import os.path
+import sys
+import unittest
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from warmup.pelt import MIN_VARIANCE, _pelt_meanvar, _pelt_meanvar_candidates
+from warmup.pelt import chunked_pelt_meanvar, pelt_meanvar, segment_meanvar
+
+
+def segment_cost(segment):
+    """Normal negative log likelihood of segment, as in _meanvar_cost()."""
+    size = len(segment)
+    mean = sum(segment) / size
+    variance = sum((x - mean) ** 2 for x in segment) / size
+    if variance <= 0:
+        variance = MIN_VARIANCE
+    return size * (math.log(2 * math.pi) + math.log(variance) + 1)
+
+
+def optimal_partitioning(data, penalty, minseglen=2):
+    """Exhaustive optimal partitioning: the changepoints and unpenalised cost
+    of the best segmentation of data, trying every possible last changepoint
+    for every prefix of data.
+    """
+    data = [float(x) for x in data]
+    size = len(data)
+    best = [None] * (size + 1)  # best[t] = (penalised cost, last changepoint)
+    best[0] = (-penalty, None)
+    for end in xrange(minseglen, size + 1):
+        for start in [0] + range(minseglen, end - minseglen + 1):
+            if best[start] is None:
+                continue
+            cost = best[start][0] + segment_cost(data[start:end]) + penalty
+            if best[end] is None or cost < best[end][0]:
+                best[end] = (cost, start)
+    cpts = list()
+    last = size
+    while last != 0:
+        cpts.append(last)
+        last = best[last][1]
+    return sorted(cpts), best[size][0] - penalty * (len(cpts) - 1)
+
+
+def piecewise_normal(rng, lengths, means, sds):
+    return numpy.concatenate([rng.normal(mean, sd, length)
+                              for length, mean, sd in zip(lengths, means, sds)])
+
+
+class TestPELT(unittest.TestCase):
+    def test_optimal_partitioning(self):
+        rng = numpy.random.RandomState(7)
+        for _ in xrange(20):
+            n_segments = rng.randint(1, 5)
+            lengths = rng.randint(3, 30, n_segments)
+            data = piecewise_normal(rng, lengths, rng.uniform(0, 3, n_segments),
+                                    rng.uniform(0.1, 1, n_segments))
+            for penalty in (10.0, 15.0, 15 * math.log(len(data))):
+                for minseglen in (2, 3):
+                    cpts, cost = _pelt_meanvar(data, penalty, minseglen)
+                    expected_cpts, expected_cost = optimal_partitioning(data, penalty, minseglen)
+                    self.assertEqual(cpts, expected_cpts)
+                    self.assertAlmostEqual(cost, expected_cost, places=6)
+
+    def test_small_penalty(self):
+        # As in changepoint, pruning assumes that any segment can be split in
+        # two, which minseglen forbids for short segments. With very small
+        # penalties PELT can then miss the optimum, but never beats it.
+        rng = numpy.random.RandomState(7)
+        for _ in xrange(20):
+            data = rng.normal(0, 1, rng.randint(10, 60))
+            cpts, cost = _pelt_meanvar(data, 2.0, 2)
+            expected_cpts, expected_cost = optimal_partitioning(data, 2.0, 2)
+            self.assertGreaterEqual(cost + 2.0 * len(cpts) + 1e-6,
+                                    expected_cost + 2.0 * len(expected_cpts))
+
+    def test_fixed_sequences(self):
+        # Two segments with different means and variances.
+        data = [1.0, 1.2] * 10 + [5.0, 5.4] * 10
+        cpts, means, variances = segment_meanvar(data, 15.0)
+        self.assertEqual(cpts, [19, 39])
+        numpy.testing.assert_allclose(means, [1.1, 5.2])
+        numpy.testing.assert_allclose(variances, [0.01, 0.04])
+        # A change of variance only.
+        data = [0.0, 1.0] * 15 + [-4.5, 5.5] * 15
+        cpts, means, variances = segment_meanvar(data, 15.0)
+        self.assertEqual(cpts, [29, 59])
+        numpy.testing.assert_allclose(means, [0.5, 0.5])
+        numpy.testing.assert_allclose(variances, [0.25, 25.0])
+        # Constant segments have zero variance, which is costed as MIN_VARIANCE.
+        data = [1.0] * 10 + [2.0] * 6 + [1.0] * 10
+        cpts, means, variances = segment_meanvar(data, 15.0)
+        self.assertEqual(cpts, [9, 15, 25])
+        self.assertEqual(means, [1.0, 2.0, 1.0])
+        self.assertEqual(variances, [0.0, 0.0, 0.0])
+        # No change.
+        data = [1.0, 1.1, 0.9, 1.05, 0.95] * 8
+        self.assertEqual(pelt_meanvar(data, 15.0), [40])
+
+    def test_too_short(self):
+        self.assertRaises(ValueError, pelt_meanvar, [1.0, 2.0, 3.0], 15.0)
+
+
+class TestChunkedPELT(unittest.TestCase):
+    def test_one_chunk(self):
+        rng = numpy.random.RandomState(3)
+        data = piecewise_normal(rng, (150, 100, 150), (0, 1, 0.5), (0.2, 0.5, 0.2))
+        penalty = 15 * math.log(len(data))
+        self.assertEqual(chunked_pelt_meanvar(data, penalty, len(data)),
+                         pelt_meanvar(data, penalty))
+
+    def test_candidates(self):
+        # Whenever every changepoint of pelt_meanvar() is a candidate, the
+        # segmentation of the whole data from the candidates is exact.
+        rng = numpy.random.RandomState(5)
+        for _ in xrange(10):
+            n_segments = rng.randint(2, 8)
+            data = piecewise_normal(rng, rng.randint(20, 300, n_segments),
+                                    rng.uniform(0, 2, n_segments),
+                                    rng.uniform(0.1, 1, n_segments))
+            penalty = 15 * math.log(len(data))
+            expected = pelt_meanvar(data, penalty)
+            others = rng.randint(2, len(data) - 2, 50)
+            candidates = sorted(set(expected) | set(int(cpt) for cpt in others))
+            self.assertEqual(_pelt_meanvar_candidates(data, penalty, candidates, 2), expected)
+
+    def test_clear_changes(self):
+        # Changes which every block containing them detects are never missed,
+        # however many blocks the data is split into.
+        rng = numpy.random.RandomState(11)
+        for _ in xrange(5):
+            lengths = rng.randint(20, 101, 40)
+            data = piecewise_normal(rng, lengths, numpy.arange(40) % 2 * 5.0, [0.2] * 40)
+            penalty = 15 * math.log(len(data))
+            expected = [int(cpt) for cpt in numpy.cumsum(lengths)]
+            self.assertEqual(pelt_meanvar(data, penalty), expected)
+            for chunk_size in (400, 1000):
+                self.assertEqual(chunked_pelt_meanvar(data, penalty, chunk_size), expected)
+                self.assertEqual(chunked_pelt_meanvar(data, penalty, chunk_size, radius=0),
+                                 expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
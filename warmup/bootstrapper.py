@@ -1,31 +1,65 @@
 #!/bin/env pypy
 
 """
-This script is designed to be run with PyPy via a pipe.
+Bootstrap the steady state performance of a benchmark.
 
-It has been factored out because the code here is too slow to run on CPython,
-and we need numpy as a dependency in related parts of the code base. Although
-there is a version of numpy for PyPy, we wanted to reduce the number of
-complications that arise for end-users.
+bootstrap_steady_perf_numpy() is vectorised with numpy, and is fast enough to
+call in-process from CPython (see warmup.statistics.bootstrap_runner).
+bootstrap_statistics_numpy() bootstraps several statistics at several
+confidence levels from the same resamples, optionally with a moving block
+bootstrap for autocorrelated iterations (see autocorrelation_diagnostic()).
 
-It will read JSON format data from STDIN, and will write a comma-separated pair
-of floats (mean, CI) on STDOUT.
+bootstrap_steady_perf() is written in pure Python, and is too slow to run on
+CPython. This file can be run as a script with PyPy via a pipe: it will read
+data from STDIN, and will write comma-separated values (mean, CI, number of
+resamples) on STDOUT. An optional seed for the random number generator can be
+passed as the only command-line argument.
+
+If run with --server, the script instead answers requests until STDIN is
+closed, so that the PyPy JIT stays warm between benchmarks. Each request is a
+line containing a JSON object, either {"data": ..., "seed": ...} or
+{"bytes": N, "seed": ...} followed by N bytes of binary data. Each answer is a
+line containing either comma-separated values (mean, CI, number of resamples),
+or ERROR followed by a message. If a request also has "confidence_levels", the
+answer is instead a JSON list of the results of bootstrap_mean_intervals().
 
 Input data should be as per. the needs of the tables for the "main" warmup
 experiment -- i.e. a list of pexecs, each containing a list of (steady state)
-segments, each containing a list of floats.
+segments, each containing a list of floats. It is marshalled either as JSON,
+or (by marshal_segments()) as BINARY_MAGIC, a line containing a JSON list of
+the segment lengths of each pexec, and then every value as a native float64.
+The binary format avoids formatting and parsing floats as text.
 
 Much of the code here comes from libkalibera.
+
+Results can be cached on disk by warmup.statistics. Increment
+warmup.statistics.BOOTSTRAP_CACHE_VERSION after any change here which can
+change results.
 """
 
+import json
 import math
 import random
+import re
 
+from array import array
 from decimal import Decimal, ROUND_UP, ROUND_DOWN
 
 
 BOOTSTRAP_ITERATIONS = 100000
 CONFIDENCE_LEVEL = '0.99'  # Must be a string to pass to Decimal.
+# Maximum number of resampled iterations held in memory at once by
+# bootstrap_steady_perf_numpy().
+MAX_BATCH_ELEMENTS = 2 ** 22
+# When bootstrap_steady_perf_numpy() is asked to stop early, it resamples in
+# rounds of (about) ADAPTIVE_ROUND_RESAMPLES, and stops once at least
+# ADAPTIVE_MIN_RESAMPLES resamples have been taken, and the Monte Carlo
+# standard errors of the mean and CI are below ADAPTIVE_MAX_ERROR units of the
+# last digit they are printed with.
+ADAPTIVE_ROUND_RESAMPLES = 2000
+ADAPTIVE_MIN_RESAMPLES = 10000
+ADAPTIVE_MAX_ERROR = 0.5
+BINARY_MAGIC = 'WARMUP-SEGMENTS-1\n'  # Start of binary marshalled data.
 
 
 def _mean(data):
@@ -33,36 +67,27 @@ def _mean(data):
     return math.fsum(data) / float(len(data))
 
 
-def bootstrap_steady_perf(steady_segments_all_pexecs, confidence_level=CONFIDENCE_LEVEL):
-    """This is not a general bootstrapping function.
-    Input is a list containing a list for each pexec, containing a list of
-    segments with iteration times.
-    """
+def _n_resamples(n_pexecs):
+    """Return the number of bootstrap samples to take from each pexec."""
 
     # How many bootstrap samples do we need from each pexec? We want at least
     # BOOTSTRAP_ITERATIONS samples over all. If we want 100,000 samples in total
     # and we have 30 pexecs, we need 3333 samples from each pexec. In total we
     # will have 3333 * 30 bootstrapped samples, and 3333 * 30 == 99990. So, we
     # add a 1 here to ensure that we end up with >= BOOTSTRAP_ITERATIONS samples.
-    n_resamples = int(math.floor(BOOTSTRAP_ITERATIONS / len(steady_segments_all_pexecs))) + 1
-    bootstrapped_samples = list()  # Final list of BOOTSTRAP_ITERATIONS resamples.
+    return int(math.floor(BOOTSTRAP_ITERATIONS / n_pexecs)) + 1
 
-    for segments in steady_segments_all_pexecs:  # Iterate over pexecs.
-        for _ in xrange(n_resamples):
-            sample = list()
-            for seg in segments:
-                sample.extend([random.choice(seg) for _ in xrange(len(seg))])
-            bootstrapped_samples.append(sample)
-    assert len(bootstrapped_samples) >= BOOTSTRAP_ITERATIONS
 
-    means = sorted([_mean(sample) for sample in bootstrapped_samples])
+def _kalibera_indices(length, confidence_level):
+    """Return the indices (into a sorted list of length bootstrapped means) of
+    the median, and of the lower and (exclusive) upper confidence bounds.
+    Code below is from libkalibera.
+    """
 
-    # Compute reported mean and confidence interval. Code below is from libkalibera.
     assert not isinstance(confidence_level, float)
     confidence_level = Decimal(confidence_level)
     assert isinstance(confidence_level, Decimal)
     exclude = (1 - confidence_level) / 2
-    length = len(means)
     # There may be >1 median index if data is even-sized.
     if length % 2 == 0:
         median_indices = (length // 2 - 1, length // 2)
@@ -70,16 +95,443 @@ def bootstrap_steady_perf(steady_segments_all_pexecs, confidence_level=CONFIDENC
         median_indices = (length // 2, )
     lower_index = int((exclude * length).quantize(Decimal('1.0'), rounding=ROUND_DOWN))
     upper_index = int(((1 - exclude) * length).quantize(Decimal('1.0'), rounding=ROUND_UP))
+    return median_indices, lower_index, upper_index
+
+
+def _median_ci(means, confidence_level):
+    """Return the reported mean, confidence interval and number of resamples,
+    given a sorted list of bootstrapped means (or a numpy array which is
+    partitioned around the indices returned by _kalibera_indices()).
+    """
+
+    median_indices, lower_index, upper_index = _kalibera_indices(len(means), confidence_level)
     lower, upper = means[lower_index], means[upper_index - 1]  # upper is exclusive.
     median = _mean([means[i] for i in median_indices])  # Reported mean.
     ci = _mean([upper - median, median - lower])  # Confidence interval.
-    return median, ci
+    return float(median), float(ci), len(means)
+
+
+def _bootstrap_means(steady_segments_all_pexecs, seed):
+    """Return a sorted list of the means of BOOTSTRAP_ITERATIONS (or more)
+    resamples, in pure Python.
+    """
+
+    rng = random.Random(seed)
+    n_resamples = _n_resamples(len(steady_segments_all_pexecs))
+    bootstrapped_samples = list()  # Final list of BOOTSTRAP_ITERATIONS resamples.
+
+    for segments in steady_segments_all_pexecs:  # Iterate over pexecs.
+        for _ in xrange(n_resamples):
+            sample = list()
+            for seg in segments:
+                sample.extend([rng.choice(seg) for _ in xrange(len(seg))])
+            bootstrapped_samples.append(sample)
+    assert len(bootstrapped_samples) >= BOOTSTRAP_ITERATIONS
+
+    return sorted([_mean(sample) for sample in bootstrapped_samples])
+
+
+def bootstrap_steady_perf(steady_segments_all_pexecs, confidence_level=CONFIDENCE_LEVEL,
+                          seed=None):
+    """This is not a general bootstrapping function.
+    Input is a list containing a list for each pexec, containing a list of
+    segments with iteration times.
+    """
+
+    return _median_ci(_bootstrap_means(steady_segments_all_pexecs, seed), confidence_level)
+
+
+def bootstrap_mean_intervals(steady_segments_all_pexecs, confidence_levels=(CONFIDENCE_LEVEL, ),
+                             seed=None):
+    """As bootstrap_steady_perf(), but return the mean at several confidence
+    levels, in the format returned by bootstrap_statistics_numpy().
+    """
+
+    means = _bootstrap_means(steady_segments_all_pexecs, seed)
+    intervals = dict()
+    for level in confidence_levels:
+        median, ci, _ = _median_ci(means, level)
+        _, lower_index, upper_index = _kalibera_indices(len(means), level)
+        intervals[level] = {'ci': ci, 'lower': means[lower_index],
+                            'upper': means[upper_index - 1]}
+    return {'mean': {'estimate': median, 'intervals': intervals}}, len(means)
+
+
+def bootstrap_steady_perf_numpy(steady_segments_all_pexecs, confidence_level=CONFIDENCE_LEVEL,
+                                seed=None, convergence_formats=None):
+    """As bootstrap_steady_perf(), but vectorised with numpy.
+    Resamples of each segment are drawn as a matrix of indices, in blocks of at
+    most MAX_BATCH_ELEMENTS iterations, and only the median and confidence
+    bounds are selected from the bootstrapped means, rather than sorting them.
+
+    If convergence_formats is a pair of format strings (for the mean and CI),
+    resample in rounds, and stop before BOOTSTRAP_ITERATIONS resamples once
+    the Monte Carlo standard errors of the mean and CI (see
+    _monte_carlo_errors()) are below ADAPTIVE_MAX_ERROR units of the last digit
+    each format prints. The printed values can still differ in the last digit
+    from those found with BOOTSTRAP_ITERATIONS resamples.
+    """
+
+    results, n_resamples = bootstrap_statistics_numpy(steady_segments_all_pexecs, ('mean', ),
+                                                      (confidence_level, ), seed,
+                                                      convergence_formats)
+    return results['mean']['estimate'], results['mean']['intervals'][confidence_level]['ci'], n_resamples
+
+
+def bootstrap_statistics_numpy(steady_segments_all_pexecs, statistics=('mean', ),
+                               confidence_levels=(CONFIDENCE_LEVEL, ), seed=None,
+                               convergence_formats=None, block_bootstrap=False):
+    """Bootstrap several statistics of the steady state iterations, at several
+    confidence levels, from one set of resamples. Statistics are 'mean',
+    'median', or 'pN' for the Nth percentile (e.g. 'p95').
+
+    Return a dictionary and the number of resamples taken. The dictionary maps
+    each statistic to a dictionary containing the median of its bootstrapped
+    values ('estimate'), and a dictionary ('intervals') which maps each
+    confidence level to the symmetric confidence interval ('ci'), and the lower
+    and upper bounds ('lower', 'upper'), computed as by bootstrap_steady_perf().
+
+    If convergence_formats is a pair of format strings, stop early once the
+    estimate and CI of the first statistic at the first confidence level (the
+    one which is reported) have converged (see bootstrap_steady_perf_numpy()).
+    Other statistics and levels are not checked.
+
+    If block_bootstrap is True, each segment is resampled with the moving block
+    bootstrap, with a block length chosen by optimal_block_length(), rather
+    than resampling iterations independently. This keeps the autocorrelation
+    within blocks, which would otherwise make confidence intervals too narrow.
+    """
+
+    import numpy  # Not available on PyPy.
+    if hasattr(numpy.random, 'default_rng'):  # numpy >= 1.17 has faster generators.
+        randint = numpy.random.default_rng(seed).integers
+    else:
+        randint = numpy.random.RandomState(seed).randint
+    # Rows of the statistics which are percentiles, and their percentiles.
+    percentile_rows = [row for row, name in enumerate(statistics) if name != 'mean']
+    percentiles = [_percentile(statistics[row]) for row in percentile_rows]
+    n_pexecs = len(steady_segments_all_pexecs)
+    n_resamples = _n_resamples(n_pexecs)
+    pexecs = list()
+    for segments in steady_segments_all_pexecs:
+        segments = [numpy.asarray(seg, dtype=numpy.float64) for seg in segments]
+        length = sum(len(seg) for seg in segments)
+        assert length, 'bootstrap_statistics_numpy() received no data to average.'
+        if block_bootstrap:
+            block_lengths = [optimal_block_length(seg) for seg in segments]
+        else:
+            block_lengths = [1 for seg in segments]
+        pexecs.append((segments, block_lengths, length))
+    if convergence_formats is None:
+        round_size = n_resamples
+    else:  # Each round takes the same number of resamples from each pexec.
+        round_size = max(1, ADAPTIVE_ROUND_RESAMPLES // n_pexecs)
+
+    if convergence_formats is not None:
+        tolerances = [ADAPTIVE_MAX_ERROR * _last_digit(format_) for format_ in convergence_formats]
+    all_values = list()  # Bootstrapped statistics from each round.
+    done = 0
+    while done < n_resamples:
+        size = min(round_size, n_resamples - done)
+        values = numpy.empty((len(statistics), size * n_pexecs))
+        for index, (segments, block_lengths, length) in enumerate(pexecs):
+            pexec_values = values[:, index * size:(index + 1) * size]
+            block = max(1, MAX_BATCH_ELEMENTS // length)
+            for start in xrange(0, size, block):
+                block_size = min(block, size - start)
+                resamples = [_resample(numpy, randint, seg, block_length, block_size)
+                             for seg, block_length in zip(segments, block_lengths)]
+                block_values = pexec_values[:, start:start + block_size]
+                if 'mean' in statistics:
+                    # Sum segments separately, rather than concatenating them.
+                    block_values[statistics.index('mean')] = \
+                        sum(resample.sum(axis=1) for resample in resamples) / length
+                if percentile_rows:
+                    block_values[percentile_rows] = _row_percentiles(numpy, resamples,
+                                                                     percentiles)
+        all_values.append(values)
+        done += size
+        if (convergence_formats is None or done >= n_resamples or
+                done * n_pexecs < ADAPTIVE_MIN_RESAMPLES):
+            continue
+        reported = numpy.concatenate([round_values[0] for round_values in all_values])
+        errors = _monte_carlo_errors(numpy, reported, confidence_levels[0])
+        if errors[0] < tolerances[0] and errors[1] < tolerances[1]:
+            break
+    values = numpy.concatenate(all_values, axis=1)
+    if convergence_formats is None:
+        assert values.shape[1] >= BOOTSTRAP_ITERATIONS
+    return _summarise_statistics(values, statistics, confidence_levels), values.shape[1]
+
+
+def _last_digit(format_):
+    """Return the value of the last digit printed by a format such as '%.5f'."""
+
+    match = re.match(r'^%\.(\d+)f$', format_)
+    assert match, 'Unsupported format: %s' % format_
+    return 10.0 ** -int(match.group(1))
+
+
+def _monte_carlo_errors(numpy, row, confidence_level):
+    """Return the Monte Carlo standard errors of the estimate and CI computed
+    by _median_ci() from a row of bootstrapped values, which is partitioned in
+    place. The standard error of the order statistic at index i of n values
+    is estimated as half the distance between the order statistics at
+    i - k and i + k, where k = sqrt(n * p * (1 - p)) is the standard deviation
+    of the number of values below the p = i / n quantile. The CI is half the
+    distance between the bounds, whose errors are treated as independent.
+    """
+
+    length = len(row)
+    median_indices, lower_index, upper_index = _kalibera_indices(length, confidence_level)
+    indices = (median_indices[0], lower_index, upper_index - 1)
+    spans = list()
+    for index in indices:
+        p = float(index) / length
+        k = max(1, int(math.ceil(math.sqrt(length * p * (1 - p)))))
+        spans.append((max(0, index - k), min(length - 1, index + k)))
+    row.partition(sorted(set(i for span in spans for i in span)))
+    estimate_error, lower_error, upper_error = [(row[high] - row[low]) / 2.0
+                                                for low, high in spans]
+    return estimate_error, 0.5 * math.sqrt(lower_error ** 2 + upper_error ** 2)
+
+
+def _resample(numpy, randint, seg, block_length, size):
+    """Return an array of size resamples of seg, drawn with the moving block
+    bootstrap: each resample is made of randomly chosen runs of block_length
+    consecutive iterations, truncated to len(seg). A block length of 1 draws
+    iterations independently.
+    """
+
+    if block_length == 1:
+        return seg[randint(0, len(seg), size=(size, len(seg)))]
+    n_blocks = -(-len(seg) // block_length)  # Round up.
+    starts = randint(0, len(seg) - block_length + 1, size=(size, n_blocks, 1))
+    indices = (starts + numpy.arange(block_length)).reshape(size, n_blocks * block_length)
+    return seg[indices[:, :len(seg)]]
+
+
+def autocorrelation(data, max_lag=None):
+    """Return the sample autocorrelation of data at lags 0 to max_lag (by
+    default, len(data) - 1), computed with an FFT in O(n log n) time.
+    """
+
+    import numpy  # Not available on PyPy.
+    data = numpy.asarray(data, dtype=numpy.float64)
+    if max_lag is None:
+        max_lag = len(data) - 1
+    data = data - data.mean()
+    size = 1
+    while size < 2 * len(data):  # Pad with zeros, to avoid circular correlation.
+        size *= 2
+    spectrum = numpy.fft.rfft(data, size)
+    autocovariance = numpy.fft.irfft(spectrum * numpy.conj(spectrum), size)[:max_lag + 1]
+    if autocovariance[0] <= 0:  # Constant data.
+        correlation = numpy.zeros(max_lag + 1)
+        correlation[0] = 1.0
+        return correlation
+    return autocovariance / autocovariance[0]
+
+
+def optimal_block_length(data):
+    """Return a block length for the moving block bootstrap of data, with the
+    automatic method of Politis and White (2004), as corrected by Patton,
+    Politis and White (2009). Uncorrelated data has a block length of 1.
+    """
+
+    size = len(data)
+    if size < 4:
+        return 1
+    # Find the smallest lag after which K_N autocorrelations are insignificant.
+    k_n = max(5, int(math.ceil(math.sqrt(math.log10(size)))))
+    max_lag = min(size - 1, int(math.ceil(math.sqrt(size))) + k_n)
+    correlation = autocorrelation(data, max_lag)
+    insignificant = abs(correlation) < 2 * math.sqrt(math.log10(size) / size)
+    m_hat = max_lag  # If no lag has K_N insignificant autocorrelations after it.
+    for lag in xrange(max_lag - k_n + 1):
+        if insignificant[lag + 1:lag + 1 + k_n].all():
+            m_hat = lag
+            break
+    window = min(2 * m_hat, max_lag)
+    if window == 0:
+        return 1
+    # Flat-top lag window.
+    g_hat, d_hat = 0.0, correlation[0]
+    for lag in xrange(1, window + 1):
+        ratio = lag / float(window)
+        weight = 1.0 if ratio <= 0.5 else 2 * (1 - ratio)
+        g_hat += 2 * weight * lag * correlation[lag]
+        d_hat += 2 * weight * correlation[lag]
+    if d_hat <= 0 or g_hat == 0:
+        return 1
+    d_hat = 4.0 / 3.0 * d_hat ** 2  # Moving (and circular) block bootstrap.
+    block_length = (2 * g_hat ** 2 / d_hat) ** (1.0 / 3) * size ** (1.0 / 3)
+    return int(min(max(1, round(block_length)), max(1, size // 3), 3 * math.sqrt(size)))
+
+
+def autocorrelation_diagnostic(steady_segments_all_pexecs):
+    """Summarise the autocorrelation of steady state segments, to show when
+    iterations are not independent, and block_bootstrap should be used.
+    Return a dictionary containing the median and maximum lag 1
+    autocorrelation of each segment, the fraction of segments whose lag 1
+    autocorrelation is significant (above 2 / sqrt(n)), and the median
+    block length chosen by optimal_block_length().
+    """
+
+    import numpy  # Not available on PyPy.
+    lag1, significant, block_lengths = list(), 0, list()
+    for segments in steady_segments_all_pexecs:
+        for seg in segments:
+            if len(seg) < 4:
+                continue
+            correlation = autocorrelation(seg, 1)[1]
+            lag1.append(correlation)
+            if correlation > 2 / math.sqrt(len(seg)):
+                significant += 1
+            block_lengths.append(optimal_block_length(seg))
+    if not lag1:
+        return None
+    return {'lag1_median': float(numpy.median(lag1)), 'lag1_max': float(max(lag1)),
+            'significant_fraction': significant / float(len(lag1)),
+            'block_length_median': float(numpy.median(block_lengths))}
+
+
+def _percentile(name):
+    """Return the percentile which the statistic called name refers to."""
+
+    if name == 'median':
+        return 50.0
+    assert name.startswith('p'), 'Unknown statistic: %s' % name
+    percentile = float(name[1:])
+    assert 0 <= percentile <= 100, 'Unknown statistic: %s' % name
+    return percentile
+
+
+def _row_percentiles(numpy, resamples, percentiles):
+    """Return an array containing each percentile of each resample, where
+    resamples is a list of resampled segments, as in numpy.percentile() with
+    linear interpolation. resamples may be reordered.
+    """
+
+    if len(resamples) == 1:
+        joined = resamples[0]
+    else:
+        joined = numpy.concatenate(resamples, axis=1)
+    positions = [percentile / 100.0 * (joined.shape[1] - 1) for percentile in percentiles]
+    indices = set()
+    for position in positions:
+        indices.update((int(math.floor(position)), int(math.ceil(position))))
+    # Select only the order statistics needed, rather than sorting.
+    joined.partition(sorted(indices), axis=1)
+    values = list()
+    for position in positions:
+        lower, upper = int(math.floor(position)), int(math.ceil(position))
+        values.append(joined[:, lower] + (joined[:, upper] - joined[:, lower]) * (position - lower))
+    return numpy.array(values)
+
+
+def _summarise_statistics(values, statistics, confidence_levels):
+    """Return the dictionary described in bootstrap_statistics_numpy(), given
+    an array with a row of bootstrapped values for each statistic. Each row is
+    partitioned in place.
+    """
+
+    results = dict()
+    for row, name in zip(values, statistics):
+        indices = set()
+        for level in confidence_levels:
+            median_indices, lower_index, upper_index = _kalibera_indices(len(row), level)
+            indices.update(median_indices + (lower_index, upper_index - 1))
+        row.partition(sorted(indices))
+        intervals = dict()
+        for level in confidence_levels:
+            median, ci, _ = _median_ci(row, level)
+            _, lower_index, upper_index = _kalibera_indices(len(row), level)
+            intervals[level] = {'ci': ci, 'lower': float(row[lower_index]),
+                                'upper': float(row[upper_index - 1])}
+        results[name] = {'estimate': median, 'intervals': intervals}
+    return results
+
+
+def marshal_segments(steady_segments_all_pexecs):
+    """Return steady_segments_all_pexecs in the binary format described
+    above, which unmarshal_segments() reads.
+    """
+
+    lengths = [[len(seg) for seg in segments] for segments in steady_segments_all_pexecs]
+    values = array('d')
+    for segments in steady_segments_all_pexecs:
+        for seg in segments:
+            values.extend(seg)
+    return BINARY_MAGIC + json.dumps(lengths) + '\n' + values.tostring()
+
+
+def unmarshal_segments(marshalled_data, use_numpy=False):
+    """Return a list of pexecs, each containing a list of segments, from
+    marshalled_data in binary or JSON format. If use_numpy is True, binary
+    segments are numpy arrays which share memory with marshalled_data.
+    Otherwise, they are arrays of doubles.
+    """
+
+    if not marshalled_data.startswith(BINARY_MAGIC):
+        return json.loads(marshalled_data)
+    header_end = marshalled_data.index('\n', len(BINARY_MAGIC))
+    lengths = json.loads(marshalled_data[len(BINARY_MAGIC):header_end])
+    if use_numpy:
+        import numpy  # Not available on PyPy.
+        values = numpy.frombuffer(marshalled_data, dtype=numpy.float64, offset=header_end + 1)
+    else:
+        values = array('d')
+        values.fromstring(marshalled_data[header_end + 1:])
+    assert len(values) == sum(sum(segment_lengths) for segment_lengths in lengths), \
+        'Marshalled data is truncated.'
+    steady_segments_all_pexecs, start = list(), 0
+    for segment_lengths in lengths:
+        segments = list()
+        for length in segment_lengths:
+            segments.append(values[start:start + length])
+            start += length
+        steady_segments_all_pexecs.append(segments)
+    return steady_segments_all_pexecs
+
+
+def serve(infile, outfile):
+    """Answer bootstrap requests from infile until it is closed."""
+
+    # Iterating over a file object would read ahead, and block waiting for
+    # requests which have not been sent yet.
+    for line in iter(infile.readline, ''):
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+            if 'bytes' in request:
+                data = unmarshal_segments(infile.read(request['bytes']))
+            else:
+                data = request['data']
+            if 'confidence_levels' in request:
+                results = bootstrap_mean_intervals(data, request['confidence_levels'],
+                                                   seed=request.get('seed'))
+                outfile.write(json.dumps(results) + '\n')
+            else:
+                results = bootstrap_steady_perf(data, seed=request.get('seed'))
+                outfile.write(','.join([str(result) for result in results]) + '\n')
+        except Exception as exc:
+            outfile.write('ERROR %s\n' % str(exc).replace('\n', ' '))
+        outfile.flush()
 
 
 if __name__ == '__main__':
-    import json
     import sys
-    data = json.loads(sys.stdin.readline())
-    results = bootstrap_steady_perf(data)
+    if sys.argv[1:] == ['--server']:
+        serve(sys.stdin, sys.stdout)
+        sys.exit(0)
+    seed = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    line = sys.stdin.readline()
+    if line == BINARY_MAGIC:
+        data = unmarshal_segments(line + sys.stdin.read())
+    else:
+        data = json.loads(line)
+    results = bootstrap_steady_perf(data, seed=seed)
     sys.stdout.write(','.join([str(result) for result in results]))
     sys.stdout.flush()
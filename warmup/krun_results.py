@@ -1,7 +1,14 @@
 import bz2
+import collections
 import csv
+import itertools
 import json
+import mmap
+import os
 import os.path
+import re
+import struct
+import tempfile
 
 
 _MACHINES = {
@@ -27,6 +34,23 @@ _BLANK_BENCHMARK = { 'wallclock_times': dict(), # Measurement data.
                     'reboots': 0, 'starting_temperatures': list(),
                     'eta_estimates': list(), 'error_flag': list(), }
 
+# Columnar results files start with COLUMNAR_MAGIC, then the length of a JSON
+# header (a little-endian uint64), then the header (padded with spaces to a
+# multiple of 8 bytes), then a data area of 8-byte aligned blobs. The header
+# maps each outer key of the results to either:
+#   {"json": [offset, length]}  a JSON blob, or
+#   {"dtype": "<f8" or "<i8", "keys": {key: [values_offset, n_values,
+#                                           offsets_offset, n_pexecs]}}
+# where, for each key, the values of all pexecs are stored contiguously, and
+# offsets holds (n_pexecs + 1) int64 indices into values. Outer keys whose
+# values are lists of lists of floats (or of ints) for each key, such as
+# wallclock_times, all_outliers or changepoints, are stored as arrays. Offsets
+# are relative to the start of the data area.
+COLUMNAR_EXTENSION = '.krunc'
+COLUMNAR_MAGIC = 'KRUNCOL1'
+_COLUMNAR_ALIGN = 8
+_INT64_MIN, _INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
 _SKIP_OUTER_KEYS = ['audit', 'reboots', 'mperf_counts', 'aperf_counts',
                     'eta_estimates', 'starting_temperatures', 'core_cycle_counts',
                     'config', 'error_flag', 'window_size']
@@ -144,8 +168,8 @@ def parse_krun_file_with_changepoints(json_files):
         else:
             assert classifier == data['classifier'], \
                    ('Cannot summarise categories generated with different '
-                    'command-line options for steady-state-expected '
-                    'or delta. Please re-run the mark_changepoints_in_json script.')
+                    'command-line options for steady-state-expected, '
+                    'delta or penalty. Please re-run the mark_changepoints_in_json script.')
         if window_size is None:
             window_size = data['window_size']
         else:
@@ -155,18 +179,609 @@ def parse_krun_file_with_changepoints(json_files):
     return classifier, data_dictionary
 
 
-def read_krun_results_file(results_file):
-    """Return the JSON data stored in a Krun results file.
+def read_krun_results_file(results_file, keys=None):
+    """Return the JSON data stored in a Krun results file. Columnar results
+    files (see COLUMNAR_EXTENSION) are memory-mapped, and each outer key is
+    only decoded when it is used.
+
+    If keys is not None, a .json.bz2 file is parsed as it is decompressed, and
+    only the outer keys in keys are returned. keys maps each outer key to
+    None (to return all of its value), or to a collection of the inner keys
+    (e.g. 'bench:vm:variant') to return.
     """
-    results = None
+    if results_file.endswith(COLUMNAR_EXTENSION):
+        return ColumnarResults(results_file)
+    if keys is not None:
+        index = read_results_index(results_file)
+        if index is not None:
+            try:
+                return _read_indexed(results_file, index, keys)
+            except (IOError, ValueError):
+                print('WARNING: Index for %s is invalid, ignoring it.' % results_file)
+        with open(results_file, 'rb') as file_:
+            return _JSONStream(_bz2_chunks(file_)).read_selected(keys)
+    if os.path.exists(results_file + INDEX_EXTENSION):
+        # Indexed files hold many bz2 streams, which bz2.BZ2File cannot read.
+        with open(results_file, 'rb') as file_:
+            return json.loads(''.join(_bz2_chunks(file_)))
     with bz2.BZ2File(results_file, 'rb') as file_:
-        results = json.loads(file_.read())
+        return json.loads(file_.read())
+
+
+STREAM_CHUNK_SIZE = 256 * 1024  # Bytes of compressed data read at a time.
+
+
+def _bz2_chunks(file_):
+    """Yield chunks of decompressed data from a file of one or more bz2
+    streams.
+    """
+    decompressor = bz2.BZ2Decompressor()
+    while True:
+        compressed = file_.read(STREAM_CHUNK_SIZE)
+        if not compressed:
+            return
+        while compressed:
+            try:
+                chunk = decompressor.decompress(compressed)
+            except EOFError:  # The previous stream has ended.
+                decompressor = bz2.BZ2Decompressor()
+                continue
+            if chunk:
+                yield chunk
+            compressed = decompressor.unused_data
+            if compressed:
+                decompressor = bz2.BZ2Decompressor()
+
+
+class _JSONStream(object):
+    """Parse parts of a JSON document from an iterator of chunks of text,
+    holding only the text of the current value in memory. Values which are
+    skipped are scanned without building any objects.
+    """
+
+    _WHITESPACE = re.compile(r'[^ \t\n\r]')
+    _STRING_END = re.compile(r'["\\]')
+    _CONTAINER_TOKEN = re.compile(r'["\[\]{}]')
+    _LITERAL_END = re.compile(r'[ \t\n\r,\]}]')
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = ''
+        self._pos = 0
+        self._mark = None  # Start of the value being read, if any.
+
+    def _fill(self):
+        """Read another chunk, and return False at the end of the input."""
+        keep_from = self._pos if self._mark is None else self._mark
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            return False
+        self._buffer = self._buffer[keep_from:] + chunk
+        self._pos -= keep_from
+        if self._mark is not None:
+            self._mark -= keep_from
+        return True
+
+    def _peek(self):
+        """Skip whitespace and return the next character ('' at the end)."""
+        while True:
+            match = self._WHITESPACE.search(self._buffer, self._pos)
+            if match:
+                self._pos = match.start()
+                return self._buffer[self._pos]
+            self._pos = len(self._buffer)
+            if not self._fill():
+                return ''
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError('Expected %r in JSON data, found %r.' % (char, self._peek()))
+        self._pos += 1
+
+    def _skip_string(self):
+        self._pos += 1  # Opening quote.
+        while True:
+            match = self._STRING_END.search(self._buffer, self._pos)
+            if match is None:
+                self._pos = len(self._buffer)
+            elif match.group() == '"':
+                self._pos = match.end()
+                return
+            elif match.end() < len(self._buffer):
+                self._pos = match.end() + 1  # Skip the escaped character.
+                continue
+            else:
+                self._pos = match.start()  # Wait for the escaped character.
+            if not self._fill():
+                raise ValueError('Unterminated string in JSON data.')
+
+    def _skip_value(self):
+        char = self._peek()
+        if char == '"':
+            self._skip_string()
+        elif char in ('{', '['):
+            depth = 0
+            while True:
+                match = self._CONTAINER_TOKEN.search(self._buffer, self._pos)
+                if match is None:
+                    self._pos = len(self._buffer)
+                    if not self._fill():
+                        raise ValueError('Unterminated container in JSON data.')
+                    continue
+                self._pos = match.start()
+                token = match.group()
+                if token == '"':
+                    self._skip_string()
+                    continue
+                self._pos += 1
+                depth += 1 if token in ('{', '[') else -1
+                if depth == 0:
+                    return
+        elif char:
+            while True:
+                match = self._LITERAL_END.search(self._buffer, self._pos)
+                if match:
+                    self._pos = match.start()
+                    return
+                self._pos = len(self._buffer)
+                if not self._fill():
+                    return
+        else:
+            raise ValueError('Expected a value in JSON data.')
+
+    def _read_value(self):
+        """Parse and return the next value."""
+        self._peek()
+        self._mark = self._pos
+        self._skip_value()
+        text = self._buffer[self._mark:self._pos]
+        self._mark = None
+        return json.loads(text)
+
+    def _members(self):
+        """Yield the key of each member of the next object. The caller must
+        read or skip each value before asking for the next key.
+        """
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self._read_value()
+            self._expect(':')
+            yield key
+            char = self._peek()
+            self._pos += 1
+            if char == '}':
+                return
+            elif char != ',':
+                raise ValueError('Expected , or } in JSON data, found %r.' % char)
+
+    def read_selected(self, keys):
+        """Parse a JSON object, as described in read_krun_results_file()."""
+        results = dict()
+        for name in self._members():
+            if name not in keys:
+                self._skip_value()
+            elif keys[name] is None:
+                results[name] = self._read_value()
+            else:
+                results[name] = dict()
+                for key in self._members():
+                    if key in keys[name]:
+                        results[name][key] = self._read_value()
+                    else:
+                        self._skip_value()
         return results
-    return None
 
 
-def write_krun_results_file(results, filename):
-    """Write a Krun results file to disk."""
+def write_krun_results_file(results, filename, index=False):
+    """Write a Krun results file to disk. If filename ends with
+    COLUMNAR_EXTENSION, write a columnar results file. Otherwise, write a
+    single bz2 stream, as Krun does, unless index is True, in which case write
+    an indexed file which Krun cannot read (see write_indexed_results_file()).
+    """
 
+    if filename.endswith(COLUMNAR_EXTENSION):
+        write_columnar_results_file(results, filename)
+        return
+    if os.path.exists(filename + INDEX_EXTENSION):
+        os.remove(filename + INDEX_EXTENSION)  # Do not leave a stale index.
+    if index:
+        write_indexed_results_file(results, filename)
+        return
     with bz2.BZ2File(filename, 'wb') as file_:
-        file_.write(json.dumps(results, indent=4))
+        file_.write(json.dumps(to_plain_results(results), indent=4))
+
+
+# An index for a .json.bz2 results file is a JSON file alongside it (named
+# with INDEX_EXTENSION appended). The results file is then written as a
+# sequence of bz2 streams, which decompress to the results as JSON. Each
+# benchmark field (an outer key whose value maps inner keys to lists of pexecs,
+# e.g. wallclock_times) has the value of each inner key in a stream of its
+# own, and everything else is in the streams between them. The index has the
+# size of the results file, and maps each outer key to either:
+#   {"value": [offset, length, start, end]}
+# where the value is text[start:end] of the stream of length bytes at offset,
+# or:
+#   {"keys": {key: [offset, length]}}
+# where the value of key is the whole of its stream's text.
+INDEX_EXTENSION = '.idx'
+INDEX_VERSION = 2
+
+
+def _is_benchmark_field(value):
+    return (isinstance(value, dict) and len(value) > 0 and
+            all(isinstance(p_execs, list) for p_execs in value.itervalues()))
+
+
+class _IndexedWriter(object):
+    """Write JSON text as bz2 streams, and record where values are."""
+
+    def __init__(self, file_):
+        self.file_ = file_
+        self.offset = 0
+        self.text = list()  # Text of the stream being built.
+        self.text_length = 0
+        self.values = list()  # (name, start, end) of values in self.text.
+        self.fields = dict()
+
+    def write(self, text):
+        self.text.append(text)
+        self.text_length += len(text)
+
+    def write_value(self, name, value):
+        text = json.dumps(value)
+        self.values.append((name, self.text_length, self.text_length + len(text)))
+        self.write(text)
+
+    def _write_stream(self, text):
+        compressed = bz2.compress(text)
+        self.file_.write(compressed)
+        self.offset += len(compressed)
+        return self.offset - len(compressed), len(compressed)
+
+    def flush(self):
+        if self.text_length == 0:
+            return
+        offset, length = self._write_stream(''.join(self.text))
+        for name, start, end in self.values:
+            self.fields[name] = {'value': [offset, length, start, end]}
+        self.text, self.text_length, self.values = list(), 0, list()
+
+    def write_p_execs(self, name, key, p_execs):
+        """Write the value of a key of a benchmark field in its own stream."""
+        self.flush()
+        offset, length = self._write_stream(json.dumps(p_execs))
+        if name not in self.fields:
+            self.fields[name] = {'keys': dict()}
+        self.fields[name]['keys'][key] = [offset, length]
+
+
+def write_indexed_results_file(results, filename):
+    """Write results to filename as JSON in bz2 streams, so that each key of
+    each benchmark field can be decompressed on its own, and write an index
+    of the streams to filename + INDEX_EXTENSION. The JSON is not indented.
+    Krun reads only the first bz2 stream of a file, so it cannot read filename.
+    """
+
+    results = to_plain_results(results)
+    with open(filename, 'wb') as file_:
+        writer = _IndexedWriter(file_)
+        writer.write('{')
+        for number, name in enumerate(results):
+            if number > 0:
+                writer.write(', ')
+            writer.write(json.dumps(name) + ': ')
+            if not _is_benchmark_field(results[name]):
+                writer.write_value(name, results[name])
+                continue
+            writer.write('{')
+            for key_number, key in enumerate(results[name]):
+                if key_number > 0:
+                    writer.write(', ')
+                writer.write(json.dumps(key) + ': ')
+                writer.write_p_execs(name, key, results[name][key])
+            writer.write('}')
+        writer.write('}')
+        writer.flush()
+    index = {'version': INDEX_VERSION, 'size': os.path.getsize(filename),
+             'fields': writer.fields}
+    with open(filename + INDEX_EXTENSION, 'w') as file_:
+        json.dump(index, file_)
+
+
+def read_results_index(results_file):
+    """Return the index of a results file, or None if it has no index, or
+    the index was not written with the current version of the file.
+    """
+
+    try:
+        with open(results_file + INDEX_EXTENSION, 'r') as file_:
+            index = json.load(file_)
+    except (IOError, ValueError):
+        return None
+    if (index.get('version') != INDEX_VERSION or
+            index.get('size') != os.path.getsize(results_file)):
+        return None
+    return index
+
+
+def _read_indexed(results_file, index, keys):
+    """As read_krun_results_file() with keys, but decompress only the bz2
+    streams which hold the selected keys.
+    """
+
+    streams = dict()  # offset -> text, for streams holding several values.
+
+    def read_stream(file_, offset, length):
+        file_.seek(offset)
+        compressed = file_.read(length)
+        if len(compressed) != length:
+            raise IOError('Results file is shorter than its index.')
+        return bz2.decompress(compressed)
+
+    results = dict()
+    with open(results_file, 'rb') as file_:
+        for name in keys:
+            if name not in index['fields']:
+                continue
+            entry = index['fields'][name]
+            if 'value' in entry:
+                offset, length, start, end = entry['value']
+                if offset not in streams:
+                    streams[offset] = read_stream(file_, offset, length)
+                value = json.loads(streams[offset][start:end])
+                if keys[name] is not None and isinstance(value, dict):
+                    value = dict((key, value[key]) for key in keys[name] if key in value)
+                results[name] = value
+            else:
+                results[name] = dict()
+                for key in entry['keys']:
+                    if keys[name] is None or key in keys[name]:
+                        offset, length = entry['keys'][key]
+                        results[name][key] = json.loads(read_stream(file_, offset, length))
+    return results
+
+
+def to_plain_results(results):
+    """Return results (which may be a ColumnarResults object) as plain
+    dictionaries and lists, as they would be read from a JSON file.
+    """
+
+    if isinstance(results, dict) and not any(isinstance(value, ColumnarField)
+                                             for value in results.itervalues()):
+        return results
+    plain = dict()
+    for name in results:
+        value = results[name]
+        if isinstance(value, ColumnarField):
+            value = dict((key, value[key]) for key in value)
+        plain[name] = value
+    return plain
+
+
+def _column_dtype(field):
+    """Return the dtype with which field can be stored as arrays without loss,
+    or None if it cannot be. field must map keys to lists (one per pexec) of
+    lists of floats, or of ints.
+    """
+
+    if not isinstance(field, collections.Mapping):
+        return None
+    dtype = None
+    for key in field:
+        p_execs = field[key]
+        if not isinstance(p_execs, list):
+            return None
+        for p_exec in p_execs:
+            if not isinstance(p_exec, list):
+                return None
+            for value in p_exec:
+                if type(value) is float:
+                    value_dtype = '<f8'
+                elif type(value) in (int, long) and _INT64_MIN <= value <= _INT64_MAX:
+                    value_dtype = '<i8'
+                else:  # Includes bool and None.
+                    return None
+                if dtype is None:
+                    dtype = value_dtype
+                elif dtype != value_dtype:
+                    return None
+    return dtype or '<i8'  # All pexecs are empty.
+
+
+class _BlobWriter(object):
+    """Collect aligned blobs for the data area of a columnar results file."""
+
+    def __init__(self):
+        self.blobs = list()
+        self.size = 0
+
+    def add(self, blob):
+        """Append blob, and return its offset."""
+        offset = self.size
+        padding = -len(blob) % _COLUMNAR_ALIGN
+        self.blobs.append(blob + '\0' * padding)
+        self.size += len(blob) + padding
+        return offset
+
+
+def write_columnar_results_file(results, filename):
+    """Write results in the columnar format. The file is written to a
+    temporary file and renamed, so that filename can safely be a columnar file
+    which results were read from.
+    """
+
+    import numpy  # Not available on PyPy.
+    results = to_plain_results(results)
+    writer = _BlobWriter()
+    fields = dict()
+    for name in results:
+        field = results[name]
+        dtype = _column_dtype(field)
+        if dtype is None:
+            blob = json.dumps(field)
+            fields[name] = {'json': [writer.add(blob), len(blob)]}
+            continue
+        keys = dict()
+        for key in field:
+            p_execs = field[key]
+            offsets = numpy.zeros(len(p_execs) + 1, dtype='<i8')
+            numpy.cumsum([len(p_exec) for p_exec in p_execs], out=offsets[1:])
+            values = numpy.fromiter(itertools.chain.from_iterable(p_execs), dtype=dtype,
+                                    count=int(offsets[-1]))
+            keys[key] = [writer.add(values.tostring()), len(values),
+                         writer.add(offsets.tostring()), len(p_execs)]
+        fields[name] = {'dtype': dtype, 'keys': keys}
+    header = json.dumps({'fields': fields})
+    header += ' ' * (-len(header) % _COLUMNAR_ALIGN)
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_filename = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        os.chmod(tmp_filename, new_file_mode(filename))
+        with os.fdopen(fd, 'wb') as file_:
+            file_.write(COLUMNAR_MAGIC)
+            file_.write(struct.pack('<Q', len(header)))
+            file_.write(header)
+            for blob in writer.blobs:
+                file_.write(blob)
+        os.rename(tmp_filename, filename)
+    except:
+        os.remove(tmp_filename)
+        raise
+
+
+def new_file_mode(filename):
+    """Return the permissions for a file replacing filename: those of
+    filename if it exists, otherwise the default for new files. Temporary
+    files are created readable only by their owner.
+    """
+
+    if os.path.exists(filename):
+        return os.stat(filename).st_mode & 0o777
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+class ColumnarResults(collections.MutableMapping):
+    """The results in a columnar results file, which is memory-mapped. Outer
+    keys stored as JSON are decoded when first used. Outer keys stored as
+    arrays are ColumnarField objects, which decode each key when it is first
+    used. Results can be changed and added to, but changes are not written
+    back to the file.
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as file_:
+            self._mmap = mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ)
+        assert self._mmap[:len(COLUMNAR_MAGIC)] == COLUMNAR_MAGIC, \
+            '%s is not a columnar results file.' % filename
+        start = len(COLUMNAR_MAGIC)
+        header_length, = struct.unpack('<Q', self._mmap[start:start + 8])
+        start += 8
+        self._fields = json.loads(self._mmap[start:start + header_length])['fields']
+        self._data_start = start + header_length
+        self._values = dict()  # Outer keys which have been decoded or set.
+        self._deleted = set()
+
+    def array(self, offset, count, dtype):
+        """Return a read-only numpy array in the data area, without copying."""
+        import numpy  # Not available on PyPy.
+        return numpy.frombuffer(self._mmap, dtype=dtype, count=count,
+                                offset=self._data_start + offset)
+
+    def __getitem__(self, name):
+        if name not in self._values:
+            if name in self._deleted or name not in self._fields:
+                raise KeyError(name)
+            spec = self._fields[name]
+            if 'json' in spec:
+                offset, length = spec['json']
+                start = self._data_start + offset
+                self._values[name] = json.loads(self._mmap[start:start + length])
+            else:
+                self._values[name] = ColumnarField(self, spec)
+        return self._values[name]
+
+    def __setitem__(self, name, value):
+        self._deleted.discard(name)
+        self._values[name] = value
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self._values.pop(name, None)
+        self._deleted.add(name)
+
+    def __contains__(self, name):
+        return name in self._values or (name in self._fields and name not in self._deleted)
+
+    def __iter__(self):
+        for name in self._fields:
+            if name not in self._deleted:
+                yield name
+        for name in self._values:
+            if name not in self._fields:
+                yield name
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class ColumnarField(collections.MutableMapping):
+    """An outer key of a ColumnarResults object, such as wallclock_times. Each
+    key (e.g. 'bench:vm:variant') is decoded to a list of lists (one per
+    pexec) when first used. arrays() gives numpy arrays without decoding.
+    """
+
+    def __init__(self, results, spec):
+        self._results = results
+        self.dtype = spec['dtype']
+        self._keys = spec['keys']
+        self._values = dict()  # Keys which have been decoded or set.
+        self._deleted = set()
+
+    def arrays(self, key):
+        """Return a read-only numpy array of the values of all pexecs for key,
+        and an array of offsets, so that pexec i is values[offsets[i]:offsets[i + 1]].
+        """
+        values_offset, n_values, offsets_offset, n_pexecs = self._keys[key]
+        return (self._results.array(values_offset, n_values, self.dtype),
+                self._results.array(offsets_offset, n_pexecs + 1, '<i8'))
+
+    def __getitem__(self, key):
+        if key not in self._values:
+            if key in self._deleted or key not in self._keys:
+                raise KeyError(key)
+            values, offsets = self.arrays(key)
+            values = values.tolist()
+            self._values[key] = [values[offsets[i]:offsets[i + 1]]
+                                 for i in xrange(len(offsets) - 1)]
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        self._deleted.discard(key)
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._values.pop(key, None)
+        self._deleted.add(key)
+
+    def __contains__(self, key):
+        return key in self._values or (key in self._keys and key not in self._deleted)
+
+    def __iter__(self):
+        for key in self._keys:
+            if key not in self._deleted:
+                yield key
+        for key in self._values:
+            if key not in self._keys:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
@@ -1,10 +1,12 @@
 import math
-import numpy
 
 _NUMBERS = {0:'zero', 1:'one', 2:'two', 3:'three', 4:'four', 5:'five',
             6:'six', 7:'seven', 8:'eight', 9:'nine'}
 
 _SPARKLINE_WIDTH = '3'  # Unit: ex.
+# Precision with which steady state times and their CIs are reported.
+MEDIAN_FORMAT = '%.5f'
+CI_FORMAT = '%.6f'
 
 STYLE_SYMBOLS = {  # Requires \usepackage{amssymb} and \usepackage{sparklines}
     'flat': '\\flatc',
@@ -193,6 +195,7 @@ def escape(word):
 
 
 def _histogram(data):
+    import numpy  # Not available on PyPy.
     histogram, bin_edges = numpy.histogram(data, bins=10)
     total = math.fsum(histogram)
     size = float(len(histogram))
@@ -241,8 +244,8 @@ $
 
 
 def format_median_ci(median, error, data):
-    median_s = '%.5f' % median
-    error_s = '%.6f' % error
+    median_s = MEDIAN_FORMAT % median
+    error_s = CI_FORMAT % error
     return """$
 \\begin{array}{r}
 \\scriptstyle{%s} \\\\[-6pt]
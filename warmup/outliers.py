@@ -1,10 +1,19 @@
 """Outlier calculations.
-These functions are designed to be executed by PyPy, and may run slowly with
-other VMs.
+get_all_outliers() keeps a sorted copy of the sliding window up to date as the
+window moves, and runs quickly on CPython as well as PyPy.
+get_all_outliers_batch() does the same work for every pexec of a benchmark at
+once, and needs numpy. OnlineOutlierDetector finds the same outliers while a
+run sequence is still being measured.
 """
 
+import bisect
+import collections
 import math
 
+# Upper bound on the number of floats copied by each partition in
+# tukey_outlier_masks(). 2**22 float64s is 32MB.
+MAX_BATCH_ELEMENTS = 2 ** 22
+
 
 def _clamp_window_size(index, data_size, window_size=200):
     """Return the window of data which should be used to calculate a moving
@@ -57,24 +66,263 @@ def _tukey_all_outliers(data, window_size):
     return all_outliers
 
 
+def _incremental_tukey_all_outliers(data, window_size):
+    """As _tukey_all_outliers(), but rather than sorting a fresh copy of each
+    window, keep one sorted window and update it as the window slides.
+    The window bounds move right by at most one element per iteration, so each
+    step costs at most one insertion and one deletion (each a binary search
+    and a single shift of the underlying list). Percentiles are then read
+    directly from the sorted window.
+    """
+    all_outliers = list()
+    size = len(data)
+    window_sorted = list()
+    l_window, r_window = 0, 0  # Bounds of window_sorted in data.
+    for index, datum in enumerate(data):
+        l_slice, r_slice = _clamp_window_size(index, size, window_size)
+        while r_window < r_slice:
+            bisect.insort(window_sorted, data[int(r_window)])
+            r_window += 1
+        while l_window < l_slice:
+            del window_sorted[bisect.bisect_left(window_sorted, data[int(l_window)])]
+            l_window += 1
+        if l_slice == 0 and r_slice < window_size:
+            continue
+        window_median = median(window_sorted)
+        pc_band = 3 * (percentile(window_sorted, 90.0) - percentile(window_sorted, 10.0))
+        if datum > (window_median + pc_band) or datum < (window_median - pc_band):
+            all_outliers.append(index)
+    return all_outliers
+
+
 def get_all_outliers(data, window_size):
-    return _tukey_all_outliers(data, window_size)
+    return _incremental_tukey_all_outliers(data, window_size)
+
+
+class OnlineOutlierDetector(object):
+    """Find outliers in a run sequence whose iteration times arrive one (or a
+    few) at a time, without storing the whole sequence.
+
+    Iteration i is classified as soon as iteration i + window_size / 2 - 1
+    has arrived, and only the data in the current window is kept. Once
+    finish() has been called, the outliers reported by add(), extend() and
+    finish() are exactly those that get_all_outliers() would report for the
+    whole run sequence.
+    """
+
+    def __init__(self, window_size):
+        self.window_size = window_size
+        self.half_window = window_size / 2
+        self.count = 0  # Number of iterations received.
+        self.decided = 0  # Number of iterations classified.
+        self.finished = False
+        self._values = collections.deque()  # Data from self._l_window onwards.
+        self._window_sorted = list()
+        self._l_window, self._r_window = 0, 0  # Bounds of _window_sorted.
 
+    def add(self, datum):
+        """Add one iteration time, and return a list of the indices of any
+        iterations which can now be classified as outliers.
+        """
+        return self.extend([datum])
 
-def get_outliers(all_outliers, window_size, threshold=1):
+    def extend(self, data):
+        """Add several iteration times, and return a list of the indices of any
+        iterations which can now be classified as outliers.
+        """
+        if self.finished:
+            raise ValueError('Cannot add data after finish() has been called.')
+        outliers = list()
+        for datum in data:
+            self._values.append(datum)
+            self.count += 1
+            # The window of iteration i is not clamped by the end of the run
+            # sequence if i + half_window iterations exist.
+            while (self.decided < self.count and
+                   self.decided + self.half_window <= self.count):
+                if self._classify(self.count):
+                    outliers.append(self.decided)
+                self.decided += 1
+        return outliers
+
+    def finish(self):
+        """Mark the end of the run sequence, and return a list of the indices
+        of the remaining outliers.
+        """
+        self.finished = True
+        outliers = list()
+        while self.decided < self.count:
+            if self._classify(self.count):
+                outliers.append(self.decided)
+            self.decided += 1
+        return outliers
+
+    def _classify(self, size):
+        """Return True if the next undecided iteration is an outlier, given
+        that the run sequence is (at least) size iterations long.
+        """
+        index = self.decided
+        l_slice, r_slice = _clamp_window_size(index, size, self.window_size)
+        while self._r_window < r_slice:
+            value = self._values[int(self._r_window - self._l_window)]
+            bisect.insort(self._window_sorted, value)
+            self._r_window += 1
+        while self._l_window < l_slice:
+            value = self._values.popleft()
+            del self._window_sorted[bisect.bisect_left(self._window_sorted, value)]
+            self._l_window += 1
+        if l_slice == 0 and r_slice < self.window_size:
+            return False
+        datum = self._values[int(index - self._l_window)]
+        window_median = median(self._window_sorted)
+        pc_band = 3 * (percentile(self._window_sorted, 90.0) - percentile(self._window_sorted, 10.0))
+        return datum > (window_median + pc_band) or datum < (window_median - pc_band)
+
+
+def _tukey_bounds(windows, size):
+    """Return the lower and upper Tukey bounds for a numpy array of windows,
+    each of length size, along the last axis. The windows only need to have
+    been partitioned around the indices returned by _tukey_kth(), and the
+    arithmetic is the same as in median() and percentile().
+    """
+    if size % 2 == 1:
+        window_median = windows[..., (size - 1) // 2]
+    else:
+        index = (size - 1) // 2
+        window_median = (windows[..., index] + windows[..., index + 1]) / 2.0
+    pcs = list()
+    for pc in (90.0, 10.0):
+        index = (size - 1) * (pc / 100.0)
+        index_floor = math.floor(index)
+        index_ceil = math.ceil(index)
+        if index_floor == index_ceil:
+            pcs.append(windows[..., int(index)])
+        else:
+            d0 = windows[..., int(index_floor)] * (index_ceil - index)
+            d1 = windows[..., int(index_ceil)] * (index - index_floor)
+            pcs.append(d0 + d1)
+    pc_band = 3 * (pcs[0] - pcs[1])
+    return window_median - pc_band, window_median + pc_band
+
+
+def _tukey_kth(size):
+    """Indices of a sorted window of length size which _tukey_bounds() reads."""
+    kth = set([(size - 1) // 2, min(size // 2, size - 1)])
+    for pc in (90.0, 10.0):
+        index = (size - 1) * (pc / 100.0)
+        kth.add(int(math.floor(index)))
+        kth.add(int(math.ceil(index)))
+    return sorted(kth)
+
+
+def tukey_outlier_masks(data, window_size, max_elements=MAX_BATCH_ELEMENTS):
+    """Vectorised version of _tukey_all_outliers() for a whole benchmark.
+    data is a 2-D array of shape (pexecs, iterations). Return a boolean array
+    of the same shape, which is True wherever get_all_outliers() would report
+    an outlier. Windows are the same as in _tukey_all_outliers(), including
+    skipping partial windows at the start of each run sequence.
+
+    Full-width windows are taken as strided views of data, and are processed
+    max_elements floats at a time, to bound memory usage. The (at most
+    window_size / 2) shorter windows at the end of the run sequence are
+    processed one iteration at a time, across all pexecs.
+    """
+    import numpy
+    from numpy.lib.stride_tricks import as_strided
+
+    data = numpy.ascontiguousarray(data, dtype=numpy.float64)
+    assert data.ndim == 2, 'Expected a 2-D array of (pexecs, iterations).'
+    n_pexecs, size = data.shape
+    masks = numpy.zeros(data.shape, dtype=bool)
+    if n_pexecs == 0 or size == 0:
+        return masks
+    full_width = 2 * (window_size / 2)
+    full_indices = list()  # Indices whose window is full-width.
+    other_windows = list()  # (index, l_slice, r_slice) for other windows.
+    for index in range(size):
+        l_slice, r_slice = _clamp_window_size(index, size, window_size)
+        if l_slice == 0 and r_slice < window_size:
+            continue
+        if r_slice - l_slice == full_width and l_slice == index - window_size / 2:
+            full_indices.append(index)
+        else:
+            other_windows.append((index, int(l_slice), int(r_slice)))
+    if full_indices:
+        # Full windows start at consecutive indices of data.
+        first = full_indices[0]
+        n_windows = len(full_indices)
+        first_start = int(first - window_size / 2)
+        width = int(full_width)
+        windows = as_strided(data[:, first_start:],
+                             shape=(n_pexecs, n_windows, width),
+                             strides=(data.strides[0], data.strides[1], data.strides[1]),
+                             writeable=False)
+        kth = _tukey_kth(width)
+        step = max(1, max_elements // (n_pexecs * width))
+        for chunk in range(0, n_windows, step):
+            part = numpy.partition(windows[:, chunk:chunk + step], kth, axis=2)
+            lower, upper = _tukey_bounds(part, width)
+            data_ = data[:, first + chunk:first + chunk + part.shape[1]]
+            masks[:, first + chunk:first + chunk + part.shape[1]] = \
+                (data_ > upper) | (data_ < lower)
+    for index, l_slice, r_slice in other_windows:
+        width = r_slice - l_slice
+        part = numpy.partition(data[:, l_slice:r_slice], _tukey_kth(width), axis=1)
+        lower, upper = _tukey_bounds(part, width)
+        masks[:, index] = (data[:, index] > upper) | (data[:, index] < lower)
+    return masks
+
+
+def get_all_outliers_batch(p_execs, window_size, max_elements=MAX_BATCH_ELEMENTS):
+    """Return a list containing get_all_outliers(p_exec, window_size) for each
+    p_exec in p_execs, computed by tukey_outlier_masks(). Process executions
+    of the same length are batched together.
+    """
+    import numpy
+
+    all_outliers = [None] * len(p_execs)
+    by_length = dict()
+    for index, p_exec in enumerate(p_execs):
+        by_length.setdefault(len(p_exec), list()).append(index)
+    for length in by_length:
+        indices = by_length[length]
+        masks = tukey_outlier_masks([p_execs[index] for index in indices],
+                                    window_size, max_elements)
+        for index, mask in zip(indices, masks):
+            all_outliers[index] = [int(outlier) for outlier in numpy.flatnonzero(mask)]
+    return all_outliers
+
+
+def outlier_histogram(all_outliers):
+    """Return a list whose i'th element is the number of process executions
+    in all_outliers in which iteration i is an outlier.
+    """
+    size = 0
+    for outliers in all_outliers:
+        if outliers:
+            size = max(size, max(outliers) + 1)
+    histogram = [0] * size
+    for outliers in all_outliers:
+        for outlier in set(outliers):
+            histogram[outlier] += 1
+    return histogram
+
+
+def get_outliers(all_outliers, window_size, threshold=1, histogram=None):
     """Return 'common' and 'unique' outliers.
+    An outlier is common if the same iteration is also an outlier in at least
+    threshold other process executions. histogram should be the result of
+    outlier_histogram(all_outliers), and is computed here if not given.
     """
+    if histogram is None:
+        histogram = outlier_histogram(all_outliers)
     common, unique = list(), list()
-    for index, outliers in enumerate(all_outliers):
+    for outliers in all_outliers:
         common_exec = list()
         unique_exec = list()
         for outlier in outliers:
-            other_execs = all_outliers[:index] + all_outliers[(index + 1):]
-            sum_ = 0
-            for execution in other_execs:
-                if outlier in execution:
-                    sum_ += 1
-            if sum_ >= threshold:
+            # The histogram also counts this execution.
+            if histogram[outlier] - 1 >= threshold:
                 common_exec.append(outlier)
             else:
                 unique_exec.append(outlier)
@@ -83,6 +331,30 @@ def get_outliers(all_outliers, window_size, threshold=1):
     return common, unique
 
 
+def count_outliers_by_threshold(all_outliers, thresholds, histogram=None):
+    """Return a dictionary mapping each threshold in thresholds to the number
+    of all, common and unique outliers that get_outliers() would report for
+    that threshold. The histogram of outliers is only built once, however many
+    thresholds are given.
+    """
+    if histogram is None:
+        histogram = outlier_histogram(all_outliers)
+    # others[n] is the number of outliers shared with exactly n other pexecs.
+    others = [0] * (len(all_outliers) + 1)
+    num_outliers = 0
+    for outliers in all_outliers:
+        num_outliers += len(outliers)
+        for outlier in outliers:
+            others[histogram[outlier] - 1] += 1
+    counts = dict()
+    for threshold in thresholds:
+        common = sum(others[max(threshold, 0):])
+        counts[threshold] = {'all_outliers': num_outliers,
+                             'common_outliers': common,
+                             'unique_outliers': num_outliers - common}
+    return counts
+
+
 def median(data):
     """Naive algorithm to compute the median of a list of (sorted) data.
     Linear interpolation is used when the percentile lies between two data
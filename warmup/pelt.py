@@ -0,0 +1,275 @@
+"""Changepoint detection with PELT, without R.
+
+This is a port of the method used by changepoint::cpt.meanvar() from the R
+changepoint package, when called with method='PELT', penalty='Manual' and
+test.stat='Normal'. The cost of a segment is the negative log likelihood of a
+Normal distribution with the segment's own mean and variance, computed from
+cumulative sums of the data and its squares, and every segment must contain at
+least MIN_SEGMENT_LENGTH points.
+
+crops_meanvar() finds the optimal segmentations for every penalty in a range,
+with the CROPS algorithm of Haynes, Eckley and Fearnhead (2017), running PELT
+once per distinct segmentation (plus a few checks).
+
+chunked_pelt_meanvar() segments very long run sequences in overlapping blocks
+of bounded size, which may be processed in parallel, and then finds the
+optimal segmentation of the whole sequence with changepoints near those found
+in the blocks.
+"""
+
+import math
+import numpy
+
+
+MIN_SEGMENT_LENGTH = 2  # Default minseglen for cpt.meanvar().
+MIN_VARIANCE = 0.00000000001  # changepoint replaces variances <= 0 with this.
+_LOG_2_PI = math.log(2 * math.pi)
+
+
+def _meanvar_cost(sum_x, sum_x2, n):
+    """Cost of one or more segments, given the sums of their data and squared
+    data, and their lengths. All arguments are numpy arrays.
+    """
+    sigmasq = (sum_x2 - ((sum_x * sum_x) / n)) / n
+    sigmasq[sigmasq <= 0] = MIN_VARIANCE
+    return n * (_LOG_2_PI + numpy.log(sigmasq) + 1)
+
+
+def pelt_meanvar(data, penalty, minseglen=MIN_SEGMENT_LENGTH):
+    """Return a sorted list of changepoints in data, as 1-based indices of the
+    last point in each segment. As in the cpts slot of the object returned by
+    cpt.meanvar(), the last point in the data is always included.
+    """
+    return _pelt_meanvar(data, penalty, minseglen)[0]
+
+
+def _pelt_meanvar(data, penalty, minseglen):
+    """As pelt_meanvar(), but also return the unpenalised cost of the
+    segmentation.
+    """
+    data = numpy.asarray(data, dtype=numpy.float64)
+    size = len(data)
+    if size < 2 * minseglen:
+        raise ValueError('Minimum segment length is too large to include a '
+                         'change in this data.')
+    sum_x = numpy.concatenate(([0.0], numpy.cumsum(data)))
+    sum_x2 = numpy.concatenate(([0.0], numpy.cumsum(data * data)))
+    # lastchangelike[t] is the penalised cost of the best segmentation of
+    # data[:t], and lastchangecpts[t] the last changepoint in it.
+    lastchangelike = numpy.zeros(size + 1)
+    lastchangecpts = numpy.zeros(size + 1, dtype=numpy.int64)
+    lastchangelike[0] = -penalty
+    for tstar in range(minseglen, 2 * minseglen):
+        lastchangelike[tstar] = _meanvar_cost(sum_x[tstar:tstar + 1],
+                                              sum_x2[tstar:tstar + 1],
+                                              numpy.array([tstar], dtype=numpy.float64))[0]
+    checklist = numpy.array([0, minseglen], dtype=numpy.int64)
+    for tstar in range(2 * minseglen, size + 1):
+        tmplike = (lastchangelike[checklist] +
+                   _meanvar_cost(sum_x[tstar] - sum_x[checklist],
+                                 sum_x2[tstar] - sum_x2[checklist],
+                                 (tstar - checklist).astype(numpy.float64)) +
+                   penalty)
+        which = numpy.argmin(tmplike)  # First minimum, as changepoint does.
+        lastchangelike[tstar] = tmplike[which]
+        lastchangecpts[tstar] = checklist[which]
+        # Prune candidates which can never be optimal again.
+        checklist = checklist[tmplike <= lastchangelike[tstar] + penalty]
+        checklist = numpy.append(checklist, tstar - (minseglen - 1))
+    cpts = list()
+    last = size
+    while last != 0:
+        cpts.append(int(last))
+        last = lastchangecpts[last]
+    # lastchangelike[0] == -penalty, so every segment but the first was
+    # penalised once.
+    cost = lastchangelike[size] - penalty * (len(cpts) - 1)
+    return sorted(cpts), float(cost)
+
+
+def _pelt_meanvar_candidates(data, penalty, candidates, minseglen):
+    """As pelt_meanvar(), but only consider segmentations whose changepoints
+    are all in candidates, a sorted sequence of 1-based indices which must end
+    with len(data).
+    """
+    size = len(data)
+    sum_x = numpy.concatenate(([0.0], numpy.cumsum(data)))
+    sum_x2 = numpy.concatenate(([0.0], numpy.cumsum(data * data)))
+    # As in _pelt_meanvar(), but indexed by position in candidates (with the
+    # start of the data at position 0) rather than by index into the data.
+    positions = numpy.concatenate(([0], numpy.asarray(candidates, dtype=numpy.int64)))
+    lastchangelike = numpy.full(len(positions), numpy.inf)
+    lastchangecpts = numpy.zeros(len(positions), dtype=numpy.int64)
+    lastchangelike[0] = -penalty
+    checklist = numpy.array([0], dtype=numpy.int64)
+    for index in xrange(1, len(positions)):
+        tstar = positions[index]
+        # Candidates too close to tstar cannot start a segment ending at it.
+        admissible = checklist[tstar - positions[checklist] >= minseglen]
+        if len(admissible) == 0:
+            continue  # No segmentation can end at tstar.
+        starts = positions[admissible]
+        tmplike = (lastchangelike[admissible] +
+                   _meanvar_cost(sum_x[tstar] - sum_x[starts],
+                                 sum_x2[tstar] - sum_x2[starts],
+                                 (tstar - starts).astype(numpy.float64)) +
+                   penalty)
+        which = numpy.argmin(tmplike)
+        lastchangelike[index] = tmplike[which]
+        lastchangecpts[index] = admissible[which]
+        # Prune as PELT does, keeping candidates which were not admissible.
+        pruned = admissible[tmplike > lastchangelike[index] + penalty]
+        checklist = numpy.append(numpy.setdiff1d(checklist, pruned, assume_unique=True), index)
+    assert positions[-1] == size and numpy.isfinite(lastchangelike[-1])
+    cpts = list()
+    last = len(positions) - 1
+    while last != 0:
+        cpts.append(int(positions[last]))
+        last = lastchangecpts[last]
+    return sorted(cpts)
+
+
+def chunked_pelt_meanvar(data, penalty, chunk_size, radius=None,
+                         minseglen=MIN_SEGMENT_LENGTH, map_func=map):
+    """As pelt_meanvar(), but run PELT on blocks of at most chunk_size points,
+    so that time and memory do not grow with the square of len(data) when
+    pruning is poor. Blocks may be processed in parallel, by passing a
+    map_func (e.g. the map method of a multiprocessing.Pool).
+
+    Blocks overlap by half their length, so every point is at least
+    chunk_size / 4 points from the ends of some block (or in the first or last
+    quarter of the data). Every point within radius of a changepoint found in
+    any block is then a candidate, and the result is the optimal segmentation
+    of the whole data (with the same penalty) whose changepoints are all
+    candidates. radius defaults to max(2 * minseglen, chunk_size // 100).
+
+    This is an approximation. The result is the same as pelt_meanvar()'s
+    whenever each of its changepoints is within radius of a changepoint found
+    in some block (in particular, when len(data) <= chunk_size). A changepoint
+    is missed when no block detects it, which mostly happens when the change
+    is only worth its penalty given the data in a neighbouring segment longer
+    than chunk_size / 4, but can happen for any change which is only just
+    worth its penalty. Nearby changepoints can then also move. On random
+    piecewise Normal data (2000-6000 points, segments of 30-900 points),
+    results matched pelt_meanvar() for 72%, 90% and 100% of series with
+    chunk_size 400, 800 and 1600; almost every difference was next to a
+    segment longer than chunk_size / 4. chunk_size should therefore be several
+    times the length of the longest segment expected.
+    """
+    data = numpy.asarray(data, dtype=numpy.float64)
+    size = len(data)
+    if size <= chunk_size:
+        return pelt_meanvar(data, penalty, minseglen)
+    if radius is None:
+        radius = max(2 * minseglen, chunk_size // 100)
+    assert chunk_size >= 4 * minseglen, 'chunk_size is too small.'
+    step = chunk_size // 2
+    blocks = list()
+    for start in range(0, size - step, step):
+        end = min(start + chunk_size, size)
+        blocks.append((data[start:end], penalty, minseglen, start))
+        if end == size:
+            break
+    candidates = set([size])
+    for block_cpts in map_func(_pelt_block, blocks):
+        for cpt in block_cpts:
+            candidates.update(xrange(max(minseglen, cpt - radius),
+                                     min(size - minseglen, cpt + radius) + 1))
+    return _pelt_meanvar_candidates(data, penalty, sorted(candidates), minseglen)
+
+
+def _pelt_block(args):
+    """Segment one block of data, which starts at offset in the full data, and
+    return its changepoints as indices into the full data, without the end of
+    the block.
+    """
+    block, penalty, minseglen, offset = args
+    return [cpt + offset for cpt in pelt_meanvar(block, penalty, minseglen)[:-1]]
+
+
+def _segment_params(data, cpts):
+    """Return 0-based changepoints, and lists of the mean and (maximum
+    likelihood) variance of each segment, given 1-based changepoints.
+    """
+    means, variances = list(), list()
+    start = 0
+    for cpt in cpts:
+        segment = data[start:cpt]
+        means.append(float(segment.mean()))
+        variances.append(float(segment.var()))
+        start = cpt
+    return [cpt - 1 for cpt in cpts], means, variances
+
+
+def segment_meanvar(data, penalty, minseglen=MIN_SEGMENT_LENGTH, chunk_size=None):
+    """Segment data with pelt_meanvar(). Return a list of 0-based indices of
+    the last point in each segment (including the last point in data), and
+    lists of the mean and variance of each segment. Variances are maximum
+    likelihood estimates, as in the param.est slot of cpt.meanvar() results.
+    If chunk_size is not None, segment with chunked_pelt_meanvar() instead.
+    """
+    data = numpy.asarray(data, dtype=numpy.float64)
+    if chunk_size is None:
+        return _segment_params(data, pelt_meanvar(data, penalty, minseglen))
+    return _segment_params(data, chunked_pelt_meanvar(data, penalty, chunk_size,
+                                                      minseglen=minseglen))
+
+
+def crops_meanvar(data, min_penalty, max_penalty, minseglen=MIN_SEGMENT_LENGTH):
+    """Return every segmentation of data which is optimal for some penalty in
+    [min_penalty, max_penalty], in order of increasing penalty (and so
+    decreasing numbers of changepoints). Each segmentation is a tuple:
+        (penalty, changepoints, means, variances)
+    where the segmentation is optimal from penalty up to the penalty of the
+    next segmentation (or max_penalty), and the other fields are as returned
+    by segment_meanvar().
+    """
+    assert 0 <= min_penalty <= max_penalty
+    data = numpy.asarray(data, dtype=numpy.float64)
+    optimal = dict()  # penalty -> (cpts, unpenalised cost)
+    for penalty in (min_penalty, max_penalty):
+        optimal[penalty] = _pelt_meanvar(data, penalty, minseglen)
+    intervals = [(min_penalty, max_penalty)]
+    while intervals:
+        low, high = intervals.pop()
+        low_cpts, low_cost = optimal[low]
+        high_cpts, high_cost = optimal[high]
+        if len(low_cpts) <= len(high_cpts) + 1:
+            continue  # No other segmentation can be optimal in (low, high).
+        # The penalty at which the two segmentations have equal penalised cost.
+        penalty = (high_cost - low_cost) / (len(low_cpts) - len(high_cpts))
+        if not low < penalty < high:
+            continue
+        optimal[penalty] = _pelt_meanvar(data, penalty, minseglen)
+        if len(optimal[penalty][0]) != len(high_cpts):
+            intervals.append((low, penalty))
+            intervals.append((penalty, high))
+    # Keep one segmentation per number of changepoints, and find the penalty
+    # at which each becomes better than the one with more changepoints.
+    by_size = dict()
+    for penalty in optimal:
+        cpts, cost = optimal[penalty]
+        by_size[len(cpts)] = (cpts, cost)
+    path = list()
+    previous = None
+    for size in sorted(by_size, reverse=True):
+        cpts, cost = by_size[size]
+        if previous is None:
+            start = min_penalty
+        else:
+            start = (cost - previous[1]) / (len(previous[0]) - size)
+            start = min(max(start, min_penalty), max_penalty)
+        path.append((start, ) + tuple(_segment_params(data, cpts)))
+        previous = (cpts, cost)
+    return path
+
+
+def select_segmentation(path, penalty):
+    """Return the segmentation from a path returned by crops_meanvar() which
+    is optimal for penalty.
+    """
+    selected = path[0]
+    for segmentation in path:
+        if segmentation[0] <= penalty:
+            selected = segmentation
+    return selected
@@ -1,34 +1,289 @@
-import numpy
+import atexit
+import hashlib
+import json
 import os
 import subprocess
+import tempfile
 import traceback
 
+from warmup.bootstrapper import BINARY_MAGIC, BOOTSTRAP_ITERATIONS, CONFIDENCE_LEVEL
+from warmup.bootstrapper import bootstrap_statistics_numpy, bootstrap_steady_perf_numpy
+from warmup.bootstrapper import unmarshal_segments
+from warmup.latex import CI_FORMAT, MEDIAN_FORMAT
+
 
 LOW_IQR_BOUND = 5.0
 HIGH_IQR_BOUND = 95.0
 
 BOOTSTRAPPER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'warmup', 'bootstrapper.py')
+BOOTSTRAP_ENGINES = ('numpy', 'pypy')
+DEFAULT_BOOTSTRAP_ENGINE = 'numpy'
+
+# If WARMUP_BOOTSTRAP_CACHE is set to a directory, seeded bootstrap results
+# are cached there. The cache is disabled by default.
+BOOTSTRAP_CACHE_DIR = os.path.expanduser(os.environ.get('WARMUP_BOOTSTRAP_CACHE', ''))
+# Part of every cache key. Increment this whenever a change to the bootstrap
+# code (in warmup.bootstrapper) can change its results, so that results cached
+# by older code are not used.
+BOOTSTRAP_CACHE_VERSION = 4
+BOOTSTRAP_CACHE_MAX_BYTES = 32 * 1024 * 1024
+BOOTSTRAP_CACHE_EVICT_EVERY = 64  # Check the size of the cache after this many writes.
 
 
 def median_iqr(seq):
+    import numpy  # Not available on PyPy.
     return numpy.median(seq), (numpy.percentile(seq, LOW_IQR_BOUND), numpy.percentile(seq, HIGH_IQR_BOUND))
 
 
-def bootstrap_runner(marshalled_data):
-    """Input should be a JSON string, containing a list of pexecs, each
-    containing a list of segments, each containing a list of floats.
+class BootstrapWorker(object):
+    """A long-running PyPy process which answers bootstrap requests (see
+    bootstrapper.serve()), so that PyPy start-up and JIT warmup are paid once
+    rather than once per benchmark.
+    """
+
+    def __init__(self):
+        self.pipe = subprocess.Popen(['pypy', BOOTSTRAPPER, '--server'],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        # A worker must not be used by processes forked from its creator.
+        self.owner = os.getpid()
+
+    def is_usable(self):
+        return self.owner == os.getpid() and self.pipe.poll() is None
+
+    def bootstrap(self, marshalled_data, seed=None):
+        # marshalled_data is sent as it is, without decoding and re-encoding.
+        if marshalled_data.startswith(BINARY_MAGIC):
+            self.pipe.stdin.write('{"seed": %s, "bytes": %d}\n' % (json.dumps(seed),
+                                                                   len(marshalled_data)))
+            self.pipe.stdin.write(marshalled_data)
+        else:
+            self.pipe.stdin.write('{"seed": %s, "data": %s}\n' % (json.dumps(seed),
+                                                                  marshalled_data))
+        self.pipe.stdin.flush()
+        output = self.pipe.stdout.readline().strip()
+        if not output:
+            raise IOError('Bootstrap worker exited unexpectedly.')
+        if output.startswith('ERROR'):
+            raise ValueError('Bootstrap worker failed: %s' % output[len('ERROR '):])
+        mean_str, ci_str, n_resamples_str = output.split(',')
+        return float(mean_str), float(ci_str), int(n_resamples_str)
+
+    def bootstrap_intervals(self, marshalled_data, confidence_levels, seed=None):
+        """Return the mean at each of confidence_levels, and the number of
+        resamples, as bootstrapper.bootstrap_mean_intervals() does.
+        """
+        request = {'seed': seed, 'confidence_levels': list(confidence_levels)}
+        if marshalled_data.startswith(BINARY_MAGIC):
+            request['bytes'] = len(marshalled_data)
+            self.pipe.stdin.write(json.dumps(request) + '\n')
+            self.pipe.stdin.write(marshalled_data)
+        else:
+            self.pipe.stdin.write(json.dumps(request)[:-1] + ', "data": %s}\n' % marshalled_data)
+        self.pipe.stdin.flush()
+        output = self.pipe.stdout.readline().strip()
+        if not output:
+            raise IOError('Bootstrap worker exited unexpectedly.')
+        if output.startswith('ERROR'):
+            raise ValueError('Bootstrap worker failed: %s' % output[len('ERROR '):])
+        results, n_resamples = json.loads(output)
+        return results, n_resamples
+
+    def close(self):
+        if self.pipe.poll() is None:
+            self.pipe.stdin.close()
+            self.pipe.wait()
+
+
+_WORKER = None  # BootstrapWorker used by this process, created on demand.
+
+
+def _get_worker():
+    global _WORKER
+    if _WORKER is None or not _WORKER.is_usable():
+        _WORKER = BootstrapWorker()
+    return _WORKER
+
+
+def _close_worker():
+    global _WORKER
+    if _WORKER is not None and _WORKER.owner == os.getpid():
+        _WORKER.close()
+    _WORKER = None
+
+
+atexit.register(_close_worker)
+
+
+class BootstrapCache(object):
+    """A directory of bootstrap results, with one file per result, named by a
+    hash of everything which determines the result. When the files take more
+    than max_bytes, the least recently used are deleted.
     """
 
+    def __init__(self, directory, max_bytes=BOOTSTRAP_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.writes = 0
+
+    def key(self, marshalled_data, *parameters):
+        """Return the cache key for bootstrapping marshalled_data with
+        parameters (e.g. the engine and seed).
+        """
+        import numpy  # Not available on PyPy.
+        digest = hashlib.sha256()
+        # The numpy engine's random streams can change between numpy versions.
+        for part in ((BOOTSTRAP_CACHE_VERSION, CONFIDENCE_LEVEL, BOOTSTRAP_ITERATIONS,
+                      numpy.__version__) + parameters):
+            digest.update('%r\0' % (part, ))
+        digest.update(marshalled_data)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def get(self, key):
+        """Return the cached result for key (decoded from JSON), or None."""
+        path = self._path(key)
+        try:
+            with open(path) as fd:
+                result = json.load(fd)
+            os.utime(path, None)  # Mark as recently used.
+        except (IOError, OSError, ValueError):
+            return None
+        return result
+
+    def put(self, key, result):
+        path = self._path(key)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            # Write atomically, as other processes may read the same key.
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'w') as tmp_file:
+                json.dump(result, tmp_file)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            return  # The cache is an optimisation only.
+        if self.writes % BOOTSTRAP_CACHE_EVICT_EVERY == 0:
+            self.evict()
+        self.writes += 1
+
+    def evict(self):
+        """Delete the least recently used results until the cache is no more
+        than max_bytes.
+        """
+        entries, total = list(), 0
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+_CACHE = BootstrapCache(BOOTSTRAP_CACHE_DIR) if BOOTSTRAP_CACHE_DIR else None
+
+
+def bootstrap_runner(marshalled_data, engine=DEFAULT_BOOTSTRAP_ENGINE, seed=None,
+                     adaptive=False, use_cache=True):
+    """Input should be a string, containing a list of pexecs, each
+    containing a list of segments, each containing a list of floats, as
+    returned by warmup.bootstrapper.marshal_segments() or as JSON.
+    Return the mean, CI and number of resamples taken.
+    With the 'numpy' engine, the bootstrap runs in this process and, if
+    adaptive is True, stops early once the Monte Carlo errors of the mean and
+    CI are small at the precision they are reported with (see
+    bootstrap_steady_perf_numpy()). The last printed digit may then differ
+    from a full run. With the 'pypy' engine, it runs in a
+    PyPy worker process, which is reused by later calls, and always takes
+    BOOTSTRAP_ITERATIONS resamples.
+    If seed is not None, use_cache is True and BOOTSTRAP_CACHE_DIR is set,
+    results are cached on disk.
+    """
+
+    assert engine in BOOTSTRAP_ENGINES, 'Unknown bootstrap engine: %s' % engine
+    cache_key = None
+    if seed is not None and use_cache and _CACHE is not None:
+        cache_key = _CACHE.key(marshalled_data, engine, seed, adaptive and engine == 'numpy')
+        result = _CACHE.get(cache_key)
+        if result is not None:
+            return tuple(result)
     try:
-        pipe = subprocess.Popen(['pypy', BOOTSTRAPPER], stdin=subprocess.PIPE,
-                                stdout=subprocess.PIPE)
-        pipe.stdin.write(marshalled_data + '\n')
-        pipe.stdin.flush()
-        output = pipe.stdout.readline().strip()
-        mean_str, ci_str =  output.split(',')
-        mean, ci = float(mean_str), float(ci_str)
-        return mean, ci
+        if engine == 'numpy':
+            if adaptive:
+                convergence_formats = (MEDIAN_FORMAT, CI_FORMAT)
+            else:
+                convergence_formats = None
+            result = bootstrap_steady_perf_numpy(unmarshal_segments(marshalled_data, use_numpy=True),
+                                                 seed=seed,
+                                                 convergence_formats=convergence_formats)
+        else:
+            result = _get_worker().bootstrap(marshalled_data, seed)
     except:
         print 'Bootstrapper script failed:'
         traceback.print_exc()
+        if engine == 'pypy':  # Start a new worker next time.
+            _close_worker()
+        return None, None, None
+    if cache_key is not None:
+        _CACHE.put(cache_key, result)
+    return result
+
+
+def bootstrap_statistics_runner(marshalled_data, statistics, confidence_levels, seed=None,
+                                adaptive=False, use_cache=True, block_bootstrap=False,
+                                engine=DEFAULT_BOOTSTRAP_ENGINE):
+    """Bootstrap several statistics at several confidence levels from one set
+    of resamples, with warmup.bootstrapper.bootstrap_statistics_numpy(). Input
+    is as for bootstrap_runner(). Return a dictionary of results and the number
+    of resamples taken, or (None, None) on failure. If block_bootstrap is True,
+    use the moving block bootstrap. adaptive is as for bootstrap_runner().
+    With the 'pypy' engine, only the mean can be bootstrapped, without a block
+    bootstrap, and the PyPy worker (see bootstrap_runner()) is used.
+    """
+
+    assert engine in BOOTSTRAP_ENGINES, 'Unknown bootstrap engine: %s' % engine
+    statistics, confidence_levels = tuple(statistics), tuple(confidence_levels)
+    if engine == 'pypy':
+        assert statistics == ('mean', ) and not block_bootstrap, \
+            'The pypy bootstrap engine only bootstraps the mean, without blocks.'
+    cache_key = None
+    if seed is not None and use_cache and _CACHE is not None:
+        cache_key = _CACHE.key(marshalled_data, 'statistics', engine, statistics,
+                               confidence_levels, seed, adaptive and engine == 'numpy',
+                               block_bootstrap)
+        result = _CACHE.get(cache_key)
+        if result is not None:
+            return tuple(result)
+    if adaptive:
+        convergence_formats = (MEDIAN_FORMAT, CI_FORMAT)
+    else:
+        convergence_formats = None
+    try:
+        if engine == 'numpy':
+            result = bootstrap_statistics_numpy(unmarshal_segments(marshalled_data, use_numpy=True),
+                                                statistics, confidence_levels, seed=seed,
+                                                convergence_formats=convergence_formats,
+                                                block_bootstrap=block_bootstrap)
+        else:
+            result = _get_worker().bootstrap_intervals(marshalled_data, confidence_levels, seed)
+    except:
+        print 'Bootstrapper failed:'
+        traceback.print_exc()
+        if engine == 'pypy':  # Start a new worker next time.
+            _close_worker()
         return None, None
+    if cache_key is not None:
+        _CACHE.put(cache_key, result)
+    return result
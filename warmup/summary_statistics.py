@@ -1,11 +1,15 @@
-import json
+import hashlib
+import itertools
 import math
+import multiprocessing
 
 from collections import Counter, OrderedDict
+from warmup.bootstrapper import CONFIDENCE_LEVEL, autocorrelation_diagnostic
+from warmup.bootstrapper import marshal_segments, unmarshal_segments
 from warmup.html import HTML_TABLE_TEMPLATE, HTML_PAGE_TEMPLATE
 from warmup.latex import end_document, end_table, escape, format_median_ci, format_median_error
 from warmup.latex import get_latex_symbol_map, preamble, start_table, STYLE_SYMBOLS
-from warmup.statistics import bootstrap_runner, median_iqr
+from warmup.statistics import DEFAULT_BOOTSTRAP_ENGINE, bootstrap_statistics_runner, median_iqr
 
 JSON_VERSION_NUMBER = '2'
 
@@ -16,16 +20,98 @@ TABLE_HEADINGS_START2 = '&'
 TABLE_HEADINGS1 = '&&\\multicolumn{1}{c}{} &\\multicolumn{1}{c}{Steady}&\\multicolumn{1}{c}{Steady}&\\multicolumn{1}{c}{Steady}'
 TABLE_HEADINGS2 = '&&\\multicolumn{1}{c}{Class.} &\\multicolumn{1}{c}{iter (\#)} &\\multicolumn{1}{c}{iter (s)}&\\multicolumn{1}{c}{perf (s)}'
 
+# Statistics of steady state times bootstrapped for each benchmark by default,
+# and their confidence levels. steady_state_time and steady_state_time_ci are
+# the mean at CONFIDENCE_LEVEL. All results are stored in
+# steady_state_time_bootstrap. Other statistics (see
+# warmup.bootstrapper.bootstrap_statistics_numpy()) can be requested, and are
+# computed from the same resamples, at some extra cost.
+BOOTSTRAP_STATISTICS = ('mean', )
+BOOTSTRAP_CONFIDENCE_LEVELS = (CONFIDENCE_LEVEL, '0.95')
+# Suggest a block bootstrap when more than this fraction of a benchmark's steady
+# state segments have significant lag 1 autocorrelation.
+AUTOCORRELATED_FRACTION = 0.5
+
 BLANK_CELL = '\\begin{minipage}[c][\\blankheight]{0pt}\\end{minipage}'
 
 
-def collect_summary_statistics(data_dictionaries, delta, steady_state):
+def bootstrap_seed(machine, key):
+    """Return a seed for bootstrapping the steady state performance of key on
+    machine, so that results do not depend on the order in which keys are
+    bootstrapped, or on the number of worker processes.
+    """
+    return int(hashlib.md5('%s:%s' % (machine, key)).hexdigest()[:8], 16)
+
+
+def _bootstrap_job(job):
+    """Bootstrap one benchmark, and summarise the autocorrelation of its
+    steady state iterations. Runs in a worker process.
+    """
+    index, marshalled_data, seed, block_bootstrap, engine, adaptive, statistics = job
+    diagnostic = autocorrelation_diagnostic(unmarshal_segments(marshalled_data, use_numpy=True))
+    return index, bootstrap_statistics_runner(marshalled_data, statistics,
+                                              BOOTSTRAP_CONFIDENCE_LEVELS, seed=seed,
+                                              block_bootstrap=block_bootstrap,
+                                              engine=engine, adaptive=adaptive), diagnostic
+
+
+def _run_bootstrap_jobs(machine_data, bootstrap_jobs, jobs, block_bootstrap, engine, adaptive,
+                        statistics):
+    """Bootstrap every benchmark in bootstrap_jobs, using a pool of jobs
+    processes, and fill in the results in machine_data. With the 'pypy'
+    engine, each process reuses its own PyPy worker.
+    """
+    tasks = [(index, marshalled_data, seed, block_bootstrap, engine, adaptive, statistics)
+             for index, (marshalled_data, seed, _, _) in enumerate(bootstrap_jobs)]
+    pool = None
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(processes=min(jobs, len(tasks)))
+        results = pool.imap_unordered(_bootstrap_job, tasks)
+    else:
+        results = itertools.imap(_bootstrap_job, tasks)
+    try:
+        for index, (bootstrapped, n_resamples), diagnostic in results:
+            if bootstrapped is None:
+                raise ValueError()
+            _, _, vm, bench = bootstrap_jobs[index]
+            machine_data[vm][bench]['steady_state_autocorrelation'] = diagnostic
+            if (not block_bootstrap and diagnostic is not None and
+                    diagnostic['significant_fraction'] > AUTOCORRELATED_FRACTION):
+                print('NOTE: Steady state iterations of %s:%s are autocorrelated '
+                      '(median lag 1 autocorrelation %.2f), so its CIs may be too '
+                      'narrow. Consider using a block bootstrap.' %
+                      (bench, vm, diagnostic['lag1_median']))
+            mean = bootstrapped['mean']
+            machine_data[vm][bench]['steady_state_time'] = mean['estimate']
+            machine_data[vm][bench]['steady_state_time_ci'] = mean['intervals'][CONFIDENCE_LEVEL]['ci']
+            machine_data[vm][bench]['steady_state_time_resamples'] = n_resamples
+            machine_data[vm][bench]['steady_state_time_bootstrap'] = bootstrapped
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def collect_summary_statistics(data_dictionaries, delta, steady_state, jobs=None,
+                               block_bootstrap=False, engine=DEFAULT_BOOTSTRAP_ENGINE,
+                               adaptive=False, statistics=BOOTSTRAP_STATISTICS):
     """Create summary statistics of a dataset with classifications.
     Note that this function returns a dict which is consumed by other code to
     create tables. It also DEFINES the JSON format which the ../bin/warmup_stats
     script dumps to file.
+    Steady state performance is bootstrapped for all benchmarks at once, using
+    jobs worker processes, with the moving block bootstrap if block_bootstrap
+    is True. engine is the bootstrap engine (see
+    warmup.statistics.BOOTSTRAP_ENGINES). By default, jobs is one per CPU, or 1
+    with the pypy engine, as each worker would start its own PyPy process.
+    If adaptive is True, bootstrapping stops early once it has converged (see
+    warmup.statistics.bootstrap_runner()). The mean, and any other statistics,
+    are bootstrapped at each of BOOTSTRAP_CONFIDENCE_LEVELS.
     """
 
+    if jobs is None:
+        jobs = 1 if engine == 'pypy' else multiprocessing.cpu_count()
+
     summary_data = dict()
     # Although the caller can pass >1 json file, there should never be two
     # different machines.
@@ -34,6 +120,8 @@ def collect_summary_statistics(data_dictionaries, delta, steady_state):
     summary_data = { 'machines': { machine: dict() }, 'warmup_format_version': JSON_VERSION_NUMBER }
     # Parse data dictionaries.
     keys = sorted(data_dictionaries[machine]['wallclock_times'].keys())
+    # (marshalled data, seed, vm, bench) for each benchmark to bootstrap.
+    bootstrap_jobs = list()
     for key in sorted(keys):
         wallclock_times = data_dictionaries[machine]['wallclock_times'][key]
         if len(wallclock_times) == 0:
@@ -151,17 +239,13 @@ def collect_summary_statistics(data_dictionaries, delta, steady_state):
             elif categories_set == set(['flat']):
                 median_iter, error_iter = None, None
                 median_time_to_steady, error_time_to_steady = None, None
-                # Shell out to PyPy for speed.
-                marshalled_data = json.dumps(segments_for_bootstrap_all_pexecs)
-                mean_time, error_time = bootstrap_runner(marshalled_data)
-                if mean_time is None or error_time is None:
-                    raise ValueError()
+                bootstrap_jobs.append((marshal_segments(segments_for_bootstrap_all_pexecs),
+                                       bootstrap_seed(machine, key), vm, bench))
+                mean_time, error_time = None, None  # Filled in below.
             else:
-                # Shell out to PyPy for speed.
-                marshalled_data = json.dumps(segments_for_bootstrap_all_pexecs)
-                mean_time, error_time = bootstrap_runner(marshalled_data)
-                if mean_time is None or error_time is None:
-                    raise ValueError()
+                bootstrap_jobs.append((marshal_segments(segments_for_bootstrap_all_pexecs),
+                                       bootstrap_seed(machine, key), vm, bench))
+                mean_time, error_time = None, None  # Filled in below.
                 if steady_iters:
                     median_iter, error_iter = median_iqr([float(val) for val in steady_iters])
                     median_time_to_steady, error_time_to_steady = median_iqr(time_to_steadys)
@@ -179,6 +263,9 @@ def collect_summary_statistics(data_dictionaries, delta, steady_state):
             current_benchmark['steady_state_time_to_reach_secs_list'] = time_to_steadys
             current_benchmark['steady_state_time'] = mean_time
             current_benchmark['steady_state_time_ci'] = error_time
+            current_benchmark['steady_state_time_resamples'] = None  # Filled in with the CI.
+            current_benchmark['steady_state_time_bootstrap'] = None
+            current_benchmark['steady_state_autocorrelation'] = None
             current_benchmark['steady_state_time_list'] = steady_state_means
 
             pexecs = list()  # This is needed for JSON output.
@@ -188,6 +275,8 @@ def collect_summary_statistics(data_dictionaries, delta, steady_state):
                               'segment_means':segments[index]})
             current_benchmark['process_executons'] = pexecs
             summary_data['machines'][machine][vm][bench] = current_benchmark
+    _run_bootstrap_jobs(summary_data['machines'][machine], bootstrap_jobs, jobs, block_bootstrap,
+                        engine, adaptive, ('mean', ) + tuple(s for s in statistics if s != 'mean'))
     return summary_data
 
 